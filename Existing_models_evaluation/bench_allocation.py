@@ -1,145 +1,464 @@
 # =================================================================================================================
-# Description: This script is used to evaluate the performance of existing models. 
-# The dataset to use is specifed by `dataset` and `level` variables. 
-# The models to evaluate are specified using `model_list`. 
-# The script will output the evaluation results in an Excel file.
+# Description: This script is used to evaluate the performance of existing models.
+# The datasets to use are specified as `dataset:level` pairs with --data, the models with --model and the attribute
+# choices with --use-work-attr (1: workplace population and iowork, 0: residential population and iores).
+# Each dataset is loaded once; its prepared arrays are memory-mapped by a pool of worker processes which fit all
+# models in parallel. The script outputs one consolidated table of parameters and metrics (--output) and a file of
+# predicted flows for each dataset and attribute choice (xlsx up to 100,000 pairs, otherwise Parquet or CSV).
+# With --neighbours or --radius, each origin is only paired with its nearest destinations (from the unit centroids,
+# see lib_spatial.py) plus a few tail pseudo-destinations (rows with ori == dest in the predicted flows), and the
+# error of this truncation against the allocation over all destinations is reported (trunc_tv, tail_share). The
+# metrics are computed on the observed pairs among the candidates (without the tail and the candidates without flow).
+# The metrics can also be broken down by distance band (--dist-bands, written to *_bands.csv) and by origin
+# (--by-origin, written to *_origins.csv).
+# With --bootstrap and --cv-folds, the origins are resampled (bootstrap with replacement, k-fold cross-validation)
+# and every model is refitted from its full-data optimum on each resample in parallel; the results hold the
+# bootstrap confidence intervals of the parameters (boot_lo, boot_hi, boot_se) and the metrics of the held-out
+# origins pooled over the folds (cv_rmse, cv_mae, cv_mape, cv_cpc).
+# With --group-by, the origins are labelled by group (e.g. us_region: the census region of the state prefix of the
+# GEOID, see lib_loaddata.unit_groups) and every model is fitted separately on the origins of each group; the shared
+# arrays are written once in group order, so the workers fit the groups in parallel on slices of the same files.
+# With --trace, the wall time and calls of each stage (loaders, pair preparation, loss evaluations, optimizer
+# iterations, metrics, output) in the main and worker processes are written to a JSON file, with --trace-memory their
+# peak memory as well (slower), and with --profile a cProfile dump (see lib_profile.py).
+# The fitted parameters are kept in a persistent cache (../Data/fit_cache, see lib_fitcache.py; --fit-cache to
+# change the folder, --no-fit-cache to disable it): a model whose arrays and settings did not change since the last
+# run is not refitted, and a changed one is fitted from the optimum on the most similar data stored before the run
+# started ('fit_source' tells which happened).
+# With --chunk-pairs, the models are fitted out of core for datasets larger than memory: each worker reads the pairs
+# from the store (see convert_store.py) in chunks of whole origins of about that many pairs, prefetching the next
+# chunk on a background thread, and accumulates the loss, gradient and metrics chunk by chunk (see
+# lib_allocation.PairChunks). The predicted flows are not written in this mode.
+# Example:
+#   python bench_allocation.py --data US:county england:mlad --model GM_Pow IO RM --use-work-attr 1 0 --jobs 8
 # =================================================================================================================
-from sklearn.metrics import mean_squared_error, mean_absolute_error, mean_absolute_percentage_error
-from numpy import exp, round
+from concurrent.futures import ProcessPoolExecutor
 from lib_loaddata import *
+from lib_allocation import OriginPartition, PairChunks, fit_allocation, fit_allocation_chunked, resample_weights
+from lib_fitcache import FIT_CACHE_DIR, FitCache, cached_fit, data_signature
+from lib_laws import FEATURES, FeatureCache, get_law, init_worker
+from lib_metrics import FlowMetrics, flow_metrics, metrics_from_sums
+from lib_output import Gather, write_results
+from lib_spatial import truncate_pairs, truncation_error
+from lib_profile import profiled, stage
+import lib_profile
 from matplotlib import pyplot as plt
-from scipy import optimize
-from math import sqrt
-import openpyxl
-
-dataset = 'US'  # ["england", "US", "BTH","gd_commute","gd_mobility"]
-level = 'county'  # ["mlad", "county", "state", "csa","subdistrict"]
-model_list = ["GM_Zipf", "GM_Pow","GM_Exp","RM","ERM","IO","OPS"]  # ["GM_Zipf", "GM_Pow","GM_Exp","RM","ERM","IO","OPS"]
-use_work_attr = True
-
-if dataset == 'gd_commute':
-    flow, dist, iores, iowork, attr = load_gd_commute_data(select_feat=['home_pop','work_pop'], level=level)
-elif dataset == 'gd_mobility':
-    flow, dist, iores, attr = load_gd_mobility_data(select_feat=['pop'], level=level)
-if dataset == 'england':
-    flow, dist, iores, iowork, attr = load_england_data_files(level=level,
-                select_feat=['respop', 'workpop'])
-elif dataset == 'US':
-    flow, dist, iores, iowork, attr = load_us_data_files(level=level,
-                select_feat=['respop', 'workpop'])
-elif dataset == 'BTH':
-    flow, dist, iores, attr = load_bth_data_files(level=level, select_feat=['pop_wan'])
-else:
-    raise NotImplementedError
-print(len(dist.keys()))
-
-reswb = openpyxl.Workbook()
-ws = reswb.active
-
-def prepare_data(ws, use_work_attr):
-    if dataset in ["england", "US","gd_commute"] and use_work_attr:
-        fid = 1  # 0: res 1: work
-        io = iowork
-    else:
-        fid = 0
-        io = iores
-    X = []
-    Y = []
-    ori_sep = [0]
-    ws.append(["ori", "dest", "dist", "io", "dpop", "opop", "vol"])
-    for o in dist.keys():
-        for d in flow[o].keys():
-            X.append([dist[o][d], io[o][d], attr[d][fid], attr[o][fid]])
-            Y.append(flow[o][d])
-            ws.append([o, d, dist[o][d], io[o][d], attr[d][fid], attr[o][fid], flow[o][d]])
-        ori_sep.append(ori_sep[-1]+len(flow[o].keys()))
-    Xarr = np.asarray(X)
-    Yarr = np.asarray(Y)
-    outflow = [sum(flow[o].values()) for o in dist.keys()]
-    return Xarr, Yarr, outflow, ori_sep
-
-# Prepare Data for running models
-Xarr, Yarr, outflow, ori_sep = prepare_data(ws, use_work_attr)
-print(len(Yarr))
-
-def allocation_law(dis, io, md, mo, param=None):
-    if type =="GM_Zipf":
-        p = md/dis
-    elif type == "GM_Pow":
-        p = md/(dis**param)
-    elif type == "GM_Exp":
-        p = md/exp(param*dis)
-    elif type == "RM":
-        p = md/((mo+io)*(mo+io+md))
-    elif type == "ERM":
-        p = ((mo+io+md)**param-(mo+io)**param)*(1+mo**param)/\
-            ((1+(mo+io)**param)*(1+(mo+io+md)**param))
-    elif type == "IO":
-        p = exp(param*io)-exp(param*(io+md))
-    elif type == "OPS":
-        p = md/(mo+io+md)
-    elif type == "custom":
-        p = (md ** 0.5127566392825407) / (dis ** 3 / md + mo)
-    else:
-        raise NotImplementedError
-    return p
-
-
-def mse_loss(param):
-    alloc = allocation_law(Xarr[:, 0], Xarr[:, 1], Xarr[:,2], Xarr[:,3], param)
-    for oid in range(len(dist.keys())):
-        stdfac = sum(alloc[ori_sep[oid]: ori_sep[oid+1]])
-        alloc[ori_sep[oid]: ori_sep[oid+1]] *= outflow[oid]/stdfac
-    return mean_squared_error(Yarr, alloc)
-
-
-def pred(param=None):
-    alloc = allocation_law(Xarr[:, 0], Xarr[:, 1], Xarr[:, 2], Xarr[:, 3], param)
-    for oid in range(len(dist.keys())):
-        stdfac = sum(alloc[ori_sep[oid]: ori_sep[oid + 1]])
-        alloc[ori_sep[oid]: ori_sep[oid + 1]] *= outflow[oid] / stdfac
-    return alloc
-
-mid = 0
-for type in model_list:
-    if type in ["GM_Pow", "GM_Exp", "IO","ERM"]:
-        if type == "IO":
-            init_param = [-0.001]  # Need Change
-            bound = [(-0.15, -0.0001)]  # IO: [(0.001, 1)]
-            met = "Nelder-Mead"  # ["BFGS","Nelder-Mead"]
+import argparse
+import shutil
+import time
+
+DATA = ['US:county']  # ["england:mlad", "england:msoa", "US:county", "BTH:county", "gd_commute:subdistrict", ...]
+MODELS = ["GM_Zipf", "GM_Pow","GM_Exp","RM","ERM","IO","OPS"]
+
+
+def uses_work_attr(dataset, use_work_attr):
+    return dataset in ["england", "US","gd_commute"] and use_work_attr
+
+
+def feature_columns(dataset, use_work_attr):
+    # Pair column of the intervening opportunities and unit attribute of the masses
+    if uses_work_attr(dataset, use_work_attr):
+        return 'iowork', STORE_FEAT[dataset][1]  # 0: res 1: work
+    return 'iores', STORE_FEAT[dataset][0]
+
+
+@profiled
+def prepare_data(dataset, od, use_work_attr, spatial=None):
+    # Table of the pairs to fit and its feature columns [dis, io, md, mo] (dis and io are views of the table).
+    # spatial: dict of centroids 'xy', 'geographic' and the 'k' or 'radius' of lib_spatial.truncate_pairs, which
+    # replaces the pairs of od by the candidate pairs of each origin and a tail pair
+    io, attr = feature_columns(dataset, use_work_attr)
+    if spatial is None:
+        return od, od.features(io, attr)
+    spatial['mass'] = np.asarray(od.units[attr], dtype=float)
+    od = truncate_pairs(od, spatial['xy'], spatial['mass'], spatial.get('k'), spatial.get('radius'),
+                        spatial['geographic'])
+    return od, [od['dist'], od['io'], od['md'], od['mo']]
+
+
+def open_shared(folder, law, origins=None):
+    # Feature cache (with the terms of the law precomputed by run_grid), Yarr, outflow and ori_sep of the arrays
+    # shared in folder, restricted to the origin range origins=(a, b) if given: the pairs of these origins are
+    # contiguous, so the arrays are views of the memory maps
+    arrays = open_arrays(folder, [*FEATURES, 'Yarr', 'outflow', 'ori_sep', *law.terms])
+    a, b = (0, len(arrays['ori_sep']) - 1) if origins is None else origins
+    ori_sep = np.asarray(arrays['ori_sep'][a:b + 1])
+    s, e = ori_sep[0], ori_sep[-1]
+    cache = FeatureCache(*[arrays[f][s:e] for f in FEATURES], terms={t: arrays[t][s:e] for t in law.terms})
+    return cache, arrays['Yarr'][s:e], arrays['outflow'][a:b], ori_sep - s
+
+
+def open_observed(folder, origins=None):
+    # Mask of the pairs counted in the metrics (see run_grid), restricted to the origin range origins=(a, b) if
+    # given: the observed pairs of a truncated table, without its tail pairs; None (all pairs) otherwise
+    if not os.path.exists(os.path.join(folder, "observed.npy")):
+        return None
+    arrays = open_arrays(folder, ['ori_sep', 'observed'])
+    a, b = (0, len(arrays['ori_sep']) - 1) if origins is None else origins
+    return arrays['observed'][arrays['ori_sep'][a]:arrays['ori_sep'][b]]
+
+
+@lib_profile.task
+def fit_model(folder, row, model, batch_size=None, error_origins=None, geographic=False, bands=None,
+              by_origin=False, origins=None, fit_cache=None, signature=None, meta=None, warm_before=None, seed=0):
+    # Fit `model` on the arrays shared in `folder` and write its prediction into row `row` of pred.npy.
+    # error_origins: origins on which the truncated allocation is compared with the exact one (truncated pairs only)
+    # bands/by_origin: the result also holds the metrics by distance band ('by_band') and by origin ('by_origin')
+    # origins: range (a, b) of the origins of one group (see open_shared), fitted on their own
+    # fit_cache: folder of the fit cache (None: always fit), signature/meta: data_signature and description of the
+    # arrays of the origins, warm_before: start of the run (see lib_fitcache.cached_fit)
+    # seed: seed of the batch of origins drawn with batch_size (see fit_allocation)
+    start = time.time()
+    law = get_law(model)
+    cache, Yarr, outflow, ori_sep = open_shared(folder, law, origins)
+    X = cache.features
+    partition = OriginPartition(ori_sep)
+    result = {'model': model, 'param': [], 'loss': np.nan, 'nfev': 0}
+    if law.params:
+        if fit_cache is None:
+            res = fit_allocation(law, cache, Yarr, outflow, partition, batch_size=batch_size, seed=seed)
         else:
-            init_param = [1.0]  # Need Change
-            bound = None  # IO: [(0.001, 1)]
-            met = "Nelder-Mead"
-        #print(mse_loss(init_param))
-        res = optimize.minimize(mse_loss, np.asarray(init_param), method=met, options={"disp": True},
-                                bounds=bound)
-        print(res.x, res.fun)
-        Ypred = pred(res.x)
+            res, result['fit_source'] = cached_fit(FitCache(fit_cache), law, cache, Yarr, outflow, partition,
+                                                   signature, {'batch_size': batch_size, 'seed': seed}, meta,
+                                                   warm_before, batch_size=batch_size, seed=seed)
+        print(model, res.x, res.fun, res.message)
+        param = res.x
+        result.update({'param': res.x.tolist(), 'loss': res.fun, 'nfev': res.nfev})
+    else:  # parameter-free model
+        param = None
+    Ypred = law.evaluate(cache, param)
+    partition.normalize(Ypred, outflow)
+
+    metrics = flow_metrics(Yarr, Ypred, ori_sep, X[0], bands, by_origin, open_observed(folder, origins))
+    result.update(metrics.result())
+    print(model, result['rmse'], result['mae'], result['mape'], result['cpc'])
+    if bands is not None:
+        result['by_band'] = metrics.band_table()
+    if by_origin:
+        result['by_origin'] = metrics.origin_table()
+        if origins is not None:
+            result['by_origin']['origin'] += origins[0]
+    if error_origins is not None:
+        spatial = open_arrays(folder, ['dest', 'xy', 'mass'])
+        result.update(truncation_error(law, param, X, spatial['dest'], ori_sep, spatial['xy'],
+                                       spatial['mass'], error_origins, outflow, geographic))
+    result['time'] = time.time() - start
+
+    pred = open_arrays(folder, ['pred'], mmap_mode='r+')['pred']
+    if origins is None:
+        pred[row] = Ypred
+    else:
+        # pred is in the order of od: the pairs of the group are scattered back to their positions (see run_grid)
+        offset = open_arrays(folder, ['ori_sep'])['ori_sep'][origins[0]]
+        pred[row, open_arrays(folder, ['perm'])['perm'][offset:offset + len(Ypred)]] = Ypred
+    pred.flush()
+    return result
+
+
+@lib_profile.task
+def fit_chunked(dataset, level, use_work_attr, model, chunk_pairs, bands=None, by_origin=False):
+    # Fit `model` out of core on the store of the dataset, read in chunks of whole origins of about chunk_pairs pairs
+    # (see lib_allocation.PairChunks), and compute its metrics the same way; same result as fit_model
+    start = time.time()
+    law = get_law(model)
+    od = load_store(dataset, level)
+    io, attr = feature_columns(dataset, use_work_attr)
+    chunks = PairChunks(lambda s, e: (od.features(io, attr, s, e), od['flow'][s:e]), od.ori_sep, od.outflow,
+                        chunk_pairs)
+    result = {'model': model, 'param': [], 'loss': np.nan, 'nfev': 0}
+    if law.params:
+        res = fit_allocation_chunked(law, chunks)
+        print(model, res.x, res.fun, res.message)
+        param = res.x
+        result.update({'param': res.x.tolist(), 'loss': res.fun, 'nfev': res.nfev})
     else:  # parameter-free model
-        Ypred = pred()
+        param = None
+
+    metrics = FlowMetrics(chunks.n_origins if by_origin else None, bands)
+    with stage('flow_metrics'):
+        for (a, b), cache, Y, F, part in chunks:
+            Ypred = part.normalize(law.evaluate(cache, param), F)
+            origin = np.repeat(np.arange(a, b), part.counts) if by_origin else None
+            metrics.update(Y, Ypred, origin, cache.features[0])
+    result.update(metrics.result())
+    print(model, result['rmse'], result['mae'], result['mape'], result['cpc'])
+    if bands is not None:
+        result['by_band'] = metrics.band_table()
+    if by_origin:
+        result['by_origin'] = metrics.origin_table()
+    result['time'] = time.time() - start
+    return result
+
+
+@lib_profile.task
+def resample_model(folder, model, param, scheme, index, seed=0, n_folds=5, origins=None):
+    # Refit `model` from its full-data optimum `param` on resample `index` of the origins (see resample_weights).
+    # The resample only reweights the origin segments of the shared arrays, so the cached terms are reused as is.
+    # For the cross-validation, the result also holds the metric sums of the held-out origins ('sums').
+    law = get_law(model)
+    cache, Yarr, outflow, ori_sep = open_shared(folder, law, origins)
+    partition = OriginPartition(ori_sep)
+    weights, heldout = resample_weights(partition.n_origins, scheme, index, seed, n_folds)
+    result = {'model': model, 'scheme': scheme, 'param': None, 'nfev': 0}
+    if law.params:
+        res = fit_allocation(law, cache, Yarr, outflow, partition, init_param=param, weights=weights)
+        param = res.x
+        result.update({'param': res.x, 'nfev': res.nfev})
+    if heldout is not None:
+        Ypred = law.evaluate(cache, param)
+        partition.normalize(Ypred, outflow)
+        metrics = flow_metrics(Yarr, Ypred, ori_sep, by_origin=True, observed=open_observed(folder, origins))
+        result['sums'] = metrics.by_origin[heldout].sum(axis=0)
+    return result
+
+
+def summarize_resamples(resamples):
+    # Bootstrap percentile intervals (95%) and standard errors of the parameters and cross-validated metrics of
+    # one model, from the results of resample_model
+    summary = {}
+    boot = np.array([r['param'] for r in resamples if r['scheme'] == 'bootstrap' and r['param'] is not None])
+    if len(boot):
+        summary.update({'boot_lo': np.percentile(boot, 2.5, axis=0).tolist(),
+                        'boot_hi': np.percentile(boot, 97.5, axis=0).tolist(),
+                        'boot_se': boot.std(axis=0, ddof=1).tolist() if len(boot) > 1 else [np.nan] * boot.shape[1]})
+    folds = [r for r in resamples if r['scheme'] == 'cv']
+    if folds:
+        metrics = metrics_from_sums(np.sum([r['sums'] for r in folds], axis=0))
+        summary.update({f'cv_{k}': float(v) for k, v in metrics.items()})
+    summary['resample_nfev'] = int(sum(r['nfev'] for r in resamples))
+    return summary
 
-    rmse = sqrt(mean_squared_error(Yarr, Ypred))
-    mae = mean_absolute_error(Yarr, Ypred)
-    mape = mean_absolute_percentage_error(Yarr, Ypred)
-    cpc = 1-sum(np.abs(Ypred-Yarr))/(sum(Yarr)+sum(Ypred))
-    print(rmse, mae, mape, cpc)
 
-    # Output Predicted Flow
-    ws.cell(row=1, column=8+mid).value = type
-    for i in range(len(Ypred)):
-        ws.cell(row=2+i, column=8+mid).value = Ypred[i]
+@profiled
+def save_predictions(filename, od, X, Yarr, models, pred, fmt='auto'):
+    columns = {'ori': Gather(od.units['id'], od.ori), 'dest': Gather(od.units['id'], od.dest),
+               'dist': X[0], 'io': X[1], 'dpop': X[2], 'opop': X[3], 'vol': Yarr}
+    for row, model in enumerate(models):
+        columns[model] = pred[row]
+    return write_results(filename, columns, fmt)
 
+
+@profiled
+def plot_prediction(filename, Yarr, Ypred):
     plt.figure(figsize=(6, 6))
     plt.loglog(Yarr, Ypred, '.', markersize=1)
-    u = np.linspace(1, max(max(Yarr), max(Ypred)), 5000)
+    top = max(np.max(Yarr), np.max(Ypred))
+    u = np.linspace(1, top, 5000)
     plt.loglog(u, u)
-    plt.xlim((0.8, 1.1*max(max(Yarr), max(Ypred))))
-    plt.ylim((0.8, 1.1*max(max(Yarr), max(Ypred))))
+    plt.xlim((0.8, 1.1*top))
+    plt.ylim((0.8, 1.1*top))
     plt.xlabel('Truth')
     plt.ylabel('Prediction')
-    plt.show()
+    plt.savefig(filename)
+    plt.close()
+
+
+def run_grid(data, models, use_work_attrs, jobs=None, batch_size=None, use_store=True, plot=False,
+             pred_format='auto', neighbours=None, radius=None, error_origins=200, centroid_scale=1., from_units=False,
+             bands=None, by_origin=False, n_boot=0, n_folds=0, seed=0, group_by=None, fit_cache=FIT_CACHE_DIR,
+             chunk_pairs=None):
+    # chunk_pairs: fit out of core from the stores (see fit_chunked), without groups, truncation or resamples
+    tmpdir = shared_tempdir("bench_")
+    variants = []
+    run_start = time.time()  # warm starts only from the fits stored before the run (see lib_fitcache.py)
+    try:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker) as pool:
+            futures = []
+            for dataset, level in data:
+                if chunk_pairs is not None and not os.path.exists(store_path(dataset, level)):
+                    raise ValueError(f"Fitting out of core needs the store of {dataset}:{level}, "
+                                     "see convert_store.py")
+                table = load_pairs(dataset, level, use_store, from_units, centroid_scale)
+                print(dataset, level, table.n_units, len(table))
+                if chunk_pairs is not None:
+                    # the workers read the store themselves
+                    for use_work_attr in sorted({uses_work_attr(dataset, u) for u in use_work_attrs}, reverse=True):
+                        key = {'dataset': dataset, 'level': level, 'use_work_attr': use_work_attr}
+                        variants.append((key, None, table, np.arange(table.n_units)))
+                        futures += [(dict(key, group=None), None, None, pool.submit(
+                            fit_chunked, dataset, level, use_work_attr, model, chunk_pairs, bands, by_origin))
+                            for model in models]
+                    continue
+                # origins in group order, and the range of each group in this order
+                order, groups = np.arange(table.n_units), [(None, (0, table.n_units))]
+                if group_by is not None:
+                    labels = unit_groups(dataset, level, table.units['id'], group_by)
+                    order = np.argsort(labels, kind='stable')
+                    names, starts = np.unique(labels[order], return_index=True)
+                    bounds = np.append(starts, table.n_units)
+                    groups = [(name, (a, b)) for name, a, b in zip(names.tolist(), bounds[:-1], bounds[1:])]
+                spatial, origins = None, None
+                if neighbours is not None or radius is not None:
+                    xy, geographic = load_centroids(dataset, level, table.units['id'])
+                    if not geographic:
+                        xy = xy * centroid_scale
+                    spatial = {'xy': xy, 'geographic': geographic, 'k': neighbours, 'radius': radius}
+                    rng = np.random.default_rng(0)
+                    origins = np.sort(rng.choice(table.n_units, min(error_origins, table.n_units), replace=False))
+                # use_work_attr has no effect on datasets without workplace attributes
+                for use_work_attr in sorted({uses_work_attr(dataset, u) for u in use_work_attrs}, reverse=True):
+                    od, X = prepare_data(dataset, table, use_work_attr, spatial)
+                    folder = os.path.join(tmpdir, f"{dataset}_{level}_{int(use_work_attr)}")
+                    Yarr, outflow, ori_sep = od['flow'], od.outflow, od.ori_sep
+                    # the metrics of a truncated table are computed on its observed pairs, as those of the full table
+                    observed = None if spatial is None else (Yarr > 0) & (od.dest != od.ori)
+                    if group_by is not None:
+                        # pairs in group order (perm: position of each of them in od)
+                        perm, sub = OriginPartition(ori_sep).select(order)
+                        X, Yarr, outflow, ori_sep = [x[perm] for x in X], Yarr[perm], outflow[order], sub.ori_sep
+                        observed = None if observed is None else observed[perm]
+                        save_arrays(folder, {'perm': perm})
+                    if observed is not None:
+                        save_arrays(folder, {'observed': observed})
+                    save_arrays(folder, {**dict(zip(FEATURES, X)), 'Yarr': Yarr, 'outflow': outflow,
+                                         'ori_sep': ori_sep})
+                    # predictions in the order of od, written in place by the workers
+                    create_array(folder, 'pred', (len(models), len(od)))
+                    # parameter-free terms of all the models, computed once and shared by the workers
+                    cache = FeatureCache(*X)
+                    save_arrays(folder, {t: cache[t] for model in models for t in get_law(model).terms})
+                    del cache
+                    if spatial is not None:
+                        save_arrays(folder, {'dest': od.dest, 'xy': spatial['xy'], 'mass': spatial['mass']})
+                    key = {'dataset': dataset, 'level': level, 'use_work_attr': use_work_attr}
+                    signatures = dict()
+                    if fit_cache is not None:
+                        # hashed once here rather than by every model
+                        for group, (a, b) in groups:
+                            s, e = ori_sep[a], ori_sep[b]
+                            signatures[group] = data_signature([x[s:e] for x in X], Yarr[s:e], outflow[a:b],
+                                                               ori_sep[a:b + 1])
+                    del X, Yarr
+                    variants.append((key, folder, od, order))
+                    for row, model in enumerate(models):
+                        for group, bounds in groups:
+                            # the truncation error is computed on the unit order, i.e. without groups
+                            futures.append((dict(key, group=group), folder, bounds, pool.submit(
+                                fit_model, folder, row, model, batch_size, origins if group_by is None else None,
+                                spatial is not None and spatial['geographic'], bands, by_origin,
+                                None if group_by is None else bounds, fit_cache, signatures.get(group),
+                                dict(key, group=group, neighbours=neighbours, radius=radius), run_start, seed)))
+            results = [dict(key, **lib_profile.merge_task(future.result()))
+                       for key, folder, bounds, future in futures]
+
+            # resamples of the origins, warm-started from the full-data optima
+            resamples = []
+            for r, (key, folder, bounds, future) in zip(results, futures):
+                param = np.array(r['param']) if r['param'] else None
+                tasks = [('bootstrap', i) for i in range(n_boot if param is not None else 0)]
+                tasks += [('cv', i) for i in range(n_folds)]
+                resamples.append([pool.submit(resample_model, folder, r['model'], param, scheme, i, seed, n_folds,
+                                              None if group_by is None else bounds) for scheme, i in tasks])
+            for r, pending in zip(results, resamples):
+                if pending:
+                    r.update(summarize_resamples([lib_profile.merge_task(f.result()) for f in pending]))
+
+        for key, folder, od, order in variants:
+            name = f"bench_{key['dataset']}_{key['level']}_{'work' if key['use_work_attr'] else 'res'}"
+            runs = [r for r in results if all(r[k] == v for k, v in key.items())]
+            if bands is not None:
+                pd.concat([r.pop('by_band').assign(model=r['model'], group=r['group'])
+                           for r in runs]).to_csv(f"{name}_bands.csv", index=False)
+            if by_origin:
+                tables = [r.pop('by_origin').assign(model=r['model'], group=r['group']) for r in runs]
+                table = pd.concat(tables)
+                table['origin'] = od.units['id'][order[table['origin']]]
+                table.to_csv(f"{name}_origins.csv", index=False)
+            if folder is None:  # fitted out of core, no predictions
+                continue
+            arrays = open_arrays(folder, [*FEATURES, 'pred'])
+            X, Yarr, pred = [arrays[f] for f in FEATURES], od['flow'], arrays['pred']
+            if group_by is not None:
+                # features back from the group order to the order of od, gathered block by block when written
+                perm = open_arrays(folder, ['perm'])['perm']
+                inv = np.empty_like(perm)
+                inv[perm] = np.arange(len(perm))
+                X = [Gather(x, inv) for x in X]
+            print(save_predictions(name, od, X, Yarr, models, pred, pred_format))
+            if plot:
+                for row, model in enumerate(models):
+                    plot_prediction(f"{name}_{model}.png", Yarr, pred[row])
+            del arrays, X, pred
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    results = pd.DataFrame(results)
+    if group_by is None:
+        results = results.drop(columns='group')
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate existing allocation models on a grid of datasets.")
+    parser.add_argument("--data", nargs="+", default=DATA, help="dataset:level pairs, e.g. US:county england:mlad")
+    parser.add_argument("--model", nargs="+", default=MODELS, help="allocation laws registered in lib_laws.py")
+    parser.add_argument("--use-work-attr", nargs="+", type=int, default=[1], choices=[0, 1])
+    parser.add_argument("--jobs", type=int, default=None, help="number of worker processes (default: all cores)")
+    parser.add_argument("--batch-size", type=int, default=None,
+                        help="number of origins in the mini-batch stage of fitting (default: full data only)")
+    parser.add_argument("--no-store", action="store_true", help="read the raw files even if a store exists")
+    parser.add_argument("--from-units", action="store_true",
+                        help="compute dist and io from the unit centroids instead of the precomputed tables "
+                             "(when there is no store)")
+    parser.add_argument("--neighbours", type=int, default=None,
+                        help="approximate allocation on the k nearest destinations of each origin (plus a tail)")
+    parser.add_argument("--radius", type=float, default=None,
+                        help="approximate allocation on the destinations within this distance of each origin "
+                             "(centroid units, km for lon/lat centroids)")
+    parser.add_argument("--error-origins", type=int, default=200,
+                        help="number of origins on which the approximate allocation is compared with the exact one")
+    parser.add_argument("--centroid-scale", type=float, default=1.,
+                        help="factor applied to projected centroids (--neighbours, --radius, --from-units), "
+                             "e.g. 0.001 for metres to km")
+    parser.add_argument("--dist-bands", nargs="+", type=float, default=None,
+                        help="edges of the distance bands of the metric breakdown, e.g. 10 50 100")
+    parser.add_argument("--by-origin", action="store_true", help="write the metrics of each origin")
+    parser.add_argument("--bootstrap", type=int, default=0,
+                        help="number of origin bootstrap resamples for the confidence intervals of the parameters")
+    parser.add_argument("--cv-folds", type=int, default=0,
+                        help="number of folds of the origin cross-validation (held-out metrics cv_*)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the bootstrap and cross-validation resamples and of the batch of --batch-size")
+    parser.add_argument("--group-by", default=None,
+                        help="fit the models separately on the origins of each group: a grouping of "
+                             "lib_loaddata.UNIT_GROUPINGS (e.g. us_region) or a column of the attribute table")
+    parser.add_argument("--trace", default=None,
+                        help="write the time and calls of each stage to this JSON file")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="also trace the peak memory allocated by each stage with tracemalloc, which slows "
+                             "the run down; implies --trace bench_trace.json if not given")
+    parser.add_argument("--profile", default=None,
+                        help="write a cProfile dump of the main process to this file (and of each worker process "
+                             "to <file>.<pid>); implies --trace bench_trace.json if not given")
+    parser.add_argument("--fit-cache", default=FIT_CACHE_DIR, help="folder of the persistent cache of the fits")
+    parser.add_argument("--no-fit-cache", action="store_true", help="always fit the models, without the cache")
+    parser.add_argument("--chunk-pairs", type=int, default=None,
+                        help="fit out of core from the store, in chunks of whole origins of about this many pairs")
+    parser.add_argument("--plot", action="store_true", help="save truth-vs-prediction plots")
+    parser.add_argument("--output", default="bench_results.csv", help="consolidated results file")
+    parser.add_argument("--pred-format", default="auto", choices=["auto", "xlsx", "parquet", "csv"],
+                        help="format of the predicted flows (auto: xlsx up to 100,000 pairs, else Parquet/CSV)")
+    args = parser.parse_args()
+
+    if args.cv_folds == 1:
+        parser.error("--cv-folds needs at least 2 folds")
+    if args.chunk_pairs is not None and (args.group_by or args.neighbours or args.radius or args.bootstrap
+                                         or args.cv_folds or args.plot or args.no_store):
+        parser.error("--chunk-pairs cannot be combined with --group-by, --neighbours, --radius, --bootstrap, "
+                     "--cv-folds, --plot or --no-store")
+    if args.trace or args.trace_memory or args.profile:
+        lib_profile.start(args.trace or "bench_trace.json", args.profile, args.trace_memory)
+    data = [tuple(d.split(":")) for d in args.data]
+    for model in args.model:
+        get_law(model)  # fail before loading any data
+    results = run_grid(data, args.model, [bool(u) for u in args.use_work_attr], args.jobs, args.batch_size,
+                       not args.no_store, args.plot, args.pred_format, args.neighbours, args.radius,
+                       args.error_origins, args.centroid_scale, args.from_units, args.dist_bands, args.by_origin,
+                       args.bootstrap, args.cv_folds, args.seed, args.group_by,
+                       None if args.no_fit_cache else args.fit_cache, args.chunk_pairs)
+    with stage('write_output'):
+        results.to_csv(args.output, index=False)
+    print(results)
 
-    mid += 1
 
-reswb.save("bench_"+ dataset + "_" + level + ".xlsx")
+if __name__ == "__main__":
+    main()
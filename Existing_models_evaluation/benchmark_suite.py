@@ -0,0 +1,241 @@
+# =================================================================================================================
+# Description: This script times the main stages of the evaluation and simulation code on synthetic datasets, so
+# that performance regressions between commits can be spotted without the real data.
+# For each size (number of units, --sizes) a synthetic dataset is written in the layouts of the real inputs: the
+# nested-dict pickles and attribute workbook of the US data (with flows, dist and io on the pairs with a flow only)
+# and the matrix/CSV files of the Guangdong data. The benchmarks time the loaders, the store, pair preparation
+# (features, law terms, truncation), one loss and gradient evaluation and one full fit of every model, and the
+# generation of synthetic flows. Each benchmark is repeated (--repeat) and its minimum and median times are stored
+# in <results-dir>/<commit>_<host>.json; --compare prints the ratios against the latest other results of this host.
+# Everything runs offline on one core (jobs=1) to limit the noise of the timings.
+# Example:
+#   python benchmark_suite.py --sizes 500 2000 10000 --compare
+# =================================================================================================================
+from lib_loaddata import *
+from lib_allocation import OriginPartition, fit_allocation
+from lib_laws import FeatureCache, TERMS, get_law
+from bench_allocation import MODELS, prepare_data
+from scipy.spatial import cKDTree
+import lib_laws
+import argparse
+import datetime
+import glob
+import json
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "../FlowSR_Julia/symbolic_regression_on_synthetic_data"))
+from lib_synthetic import generate_flows
+
+SIZES = [500, 2000, 10000]
+N_DEST = 100  # destinations with a flow per origin in the synthetic datasets
+GD_MAX_UNITS = 5000  # the Guangdong layout stores a dense N x N flow matrix
+RESULTS_DIR = "benchmark_results"
+
+
+def make_fixture(root, n_units, n_dest=N_DEST, seed=0):
+    # Synthetic dataset of n_units under root/Data/US (level 'county') and, up to GD_MAX_UNITS, in the Guangdong
+    # layout read from root/work (the working directory of the loaders). Units are scattered over the contiguous US
+    # with GEOID-like ids; each origin sends gravity-like flows to its n_dest nearest units.
+    rng = np.random.default_rng(seed)
+    states = sorted(US_REGION_STATE)
+    ids = np.array([states[i % len(states)] * 1000 + i // len(states) + 1 for i in range(n_units)])
+    lonlat = np.column_stack([rng.uniform(-124, -67, n_units), rng.uniform(25, 49, n_units)])
+    respop = rng.lognormal(1, 1, n_units)
+    workpop = respop * rng.lognormal(0, 0.3, n_units)
+
+    n_dest = min(n_dest, n_units - 1)
+    _, nearest = cKDTree(lonlat).query(lonlat, n_dest + 1)
+    ori = np.repeat(np.arange(n_units), n_dest)
+    dest = nearest[:, 1:].ravel()
+    feats = pair_features(lonlat, ori, dest, {'iores': respop, 'iowork': workpop}, geographic=True, jobs=1)
+    flow = rng.poisson(1000 * respop[ori] * workpop[dest] / (1 + feats['dist']) ** 1.5).astype(float)
+    flow[::n_dest] += 1  # every unit is an origin (a key of the nested dicts), as in the real data
+    keep = flow > 0
+    ori, dest, flow = ori[keep], dest[keep], flow[keep]
+    feats = {k: v[keep] for k, v in feats.items()}
+
+    data_dir = os.path.join(root, "Data", "US")
+    work_dir = os.path.join(root, "work")
+    os.makedirs(data_dir, exist_ok=True)
+    os.makedirs(work_dir, exist_ok=True)
+    for name, values in [('us_acs15_county_flow', flow), ('us_county_dist', feats['dist']),
+                         ('us_county_iores', feats['iores']), ('us_county_iowork', feats['iowork'])]:
+        nested = dict()
+        for o, d, v in zip(ids[ori].tolist(), ids[dest].tolist(), values.tolist()):
+            nested.setdefault(o, dict())[d] = v
+        with open(os.path.join(data_dir, name + ".pkl"), "wb") as f:
+            pickle.dump(nested, f)
+    book = openpyxl.Workbook()
+    sheet = book.active
+    sheet.title = 'attr'
+    sheet.append(['GEOID', 'NAME', 'ALAND', 'respop', 'employedpop', 'workpop', 'lon', 'lat'])
+    for i in range(n_units):
+        sheet.append([str(ids[i]), f"unit {i}", 0, respop[i], respop[i], workpop[i], lonlat[i, 0], lonlat[i, 1]])
+    book.save(os.path.join(data_dir, "us_acs15_county_attr.xlsx"))
+
+    if n_units <= GD_MAX_UNITS:
+        def gd_path(name):
+            # file names of load_gd_commute_data, a folder ../GD_data/Commuting_county on Windows
+            path = os.path.join(work_dir, r"..\GD_data\Commuting_county\gd_commute_" + name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            return path
+        matrix = np.zeros((n_units, n_units))
+        matrix[ori, dest] = flow
+        np.save(gd_path("flow_matrix_intercounty.npy"), matrix)
+        del matrix
+        with open(gd_path("ids_mapping_intercounty.pkl"), "wb") as f:
+            pickle.dump(dict(enumerate(ids.tolist())), f)
+        pd.DataFrame({'county': ids, 'home_pop': respop, 'work_pop': workpop, 'lon': lonlat[:, 0],
+                      'lat': lonlat[:, 1]}).to_csv(gd_path("attr_intercounty.csv"), index=False)
+        pairs = {'o_id': ids[ori], 'd_id': ids[dest]}
+        pd.DataFrame({**pairs, 'geodesic_dist': feats['dist']}).to_csv(gd_path("dist_intercounty.csv"), index=False)
+        for io, suffix in [('iores', 'res'), ('iowork', 'work')]:
+            pd.DataFrame({**pairs, 'opportunity': feats[io]}).to_csv(gd_path(f"opportunity_intercounty_{suffix}.csv"),
+                                                                   index=False)
+    return len(flow)
+
+
+def timed(func, repeat):
+    # Minimum and median wall time of `repeat` calls of func, and the result of the last call
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return {'min': min(times), 'median': float(np.median(times)), 'repeat': repeat}, result
+
+
+def run_suite(root, n_units, repeat=3, models=MODELS):
+    # Time all the benchmarks on the synthetic dataset of root (see make_fixture). Returns {name: timing}
+    results = dict()
+
+    def bench(name, func, n=repeat):
+        results[name], result = timed(func, n)
+        print(f"{n_units:>6} {name:<28} {results[name]['min']:.4f}s")
+        return result
+
+    cwd = os.getcwd()
+    os.chdir(os.path.join(root, "work"))
+    try:
+        flow, dist, iores, iowork, attr = bench('load_us_data_files', lambda: load_us_data_files(
+            'county', select_feat=STORE_FEAT['US']))
+        od = bench('pairs_from_dicts', lambda: pairs_from_dicts(flow, dist, iores, iowork, attr, STORE_FEAT['US']))
+        del flow, dist, iores, iowork, attr
+        bench('pairs_from_units', lambda: pairs_from_units('US', 'county', jobs=1))
+        if n_units <= GD_MAX_UNITS:
+            bench('load_gd_csr', lambda: load_gd_commute_data(STORE_FEAT['gd_commute'], 'county', csr=True))
+        store_dir = os.path.join(root, "store")
+        bench('convert_to_store', lambda: convert_to_store('US', 'county', store_dir=store_dir), n=1)
+        bench('load_store', lambda: load_store('US', 'county', store_dir=store_dir))
+        xy, geographic = load_centroids('US', 'county', od.units['id'])
+    finally:
+        os.chdir(cwd)
+
+    table = od
+    od, X = bench('prepare_data', lambda: prepare_data('US', table, True))
+    bench('feature_terms', lambda: [FeatureCache(*X)[t] for t in TERMS])
+    bench('truncate_pairs', lambda: prepare_data('US', table, True, {'xy': xy, 'geographic': geographic, 'k': 20}))
+
+    cache = FeatureCache(*X)
+    Yarr, outflow = od['flow'], od.outflow
+    partition = OriginPartition(od.ori_sep)
+    for model in models:
+        law = get_law(model)
+        param = law.init if law.params else None
+        if law.params:
+            bench(f'loss_{model}', lambda: partition.normalized_mse(law.evaluate(cache, param), Yarr, outflow,
+                                                                     law.evaluate_grad(cache, param)))
+            bench(f'fit_{model}', lambda: fit_allocation(law, cache, Yarr, outflow, partition))
+        else:
+            bench(f'loss_{model}', lambda: partition.normalized_mse(law.evaluate(cache), Yarr, outflow))
+
+    law = get_law('GM_Pow')
+
+    def generate():
+        with tempfile.TemporaryFile() as out:
+            return generate_flows(law, [1.5], X, od.dest, od.ori_sep, outflow, np.random.default_rng(0), out,
+                                  'mul', 0.1)
+    bench('generate_flows', generate)
+    return results
+
+
+def git_commit():
+    # Short hash of HEAD (with a "+" if the tree has uncommitted changes), "unknown" outside of a git checkout
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True,
+                               text=True, check=True).stdout.strip()
+        return commit + ("+" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results, previous, threshold=1.2):
+    # Ratios of the minimum times against previous results; benchmarks slower by more than threshold are flagged
+    rows = []
+    for size, benches in results['sizes'].items():
+        for name, timing in benches.items():
+            before = previous['sizes'].get(size, dict()).get(name)
+            if before is None:
+                continue
+            ratio = timing['min'] / before['min']
+            rows.append({'n_units': size, 'benchmark': name, 'before': before['min'], 'after': timing['min'],
+                         'ratio': ratio, 'flag': 'slower' if ratio > threshold else
+                         ('faster' if ratio < 1 / threshold else '')})
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the evaluation and simulation stages on synthetic datasets.")
+    parser.add_argument("--sizes", nargs="+", type=int, default=SIZES, help="numbers of units of the datasets")
+    parser.add_argument("--model", nargs="+", default=MODELS, help="models of the loss and fit benchmarks")
+    parser.add_argument("--repeat", type=int, default=3, help="calls of each benchmark (the minimum is kept)")
+    parser.add_argument("--results-dir", default=RESULTS_DIR, help="folder of the stored results")
+    parser.add_argument("--fixture-dir", default=None,
+                        help="folder of the synthetic datasets, kept and reused between runs (default: temporary)")
+    parser.add_argument("--compare", action="store_true",
+                        help="compare with the latest results of another commit on this host")
+    parser.add_argument("--threshold", type=float, default=1.2, help="ratio above which a benchmark is flagged")
+    args = parser.parse_args()
+
+    fixture_dir = args.fixture_dir or tempfile.mkdtemp(prefix="flowsr_bench_")
+    results = {'commit': git_commit(), 'host': socket.gethostname(), 'date': datetime.datetime.now().isoformat(),
+               'python': platform.python_version(), 'numpy': np.__version__, 'backend': lib_laws.BACKEND,
+               'sizes': dict()}
+    try:
+        for n_units in args.sizes:
+            root = os.path.join(fixture_dir, str(n_units))
+            if not os.path.exists(os.path.join(root, "Data", "US", "us_acs15_county_attr.xlsx")):
+                print(f"writing a synthetic dataset of {n_units} units, {make_fixture(root, n_units)} pairs")
+            results['sizes'][str(n_units)] = run_suite(root, n_units, args.repeat, args.model)
+    finally:
+        if args.fixture_dir is None:
+            shutil.rmtree(fixture_dir, ignore_errors=True)
+
+    os.makedirs(args.results_dir, exist_ok=True)
+    filename = os.path.join(args.results_dir, f"{results['commit']}_{results['host']}.json")
+    with open(filename, "w") as f:
+        json.dump(results, f, indent=1)
+    print(f"results written to {filename}")
+
+    if args.compare:
+        files = [f for f in glob.glob(os.path.join(args.results_dir, f"*_{results['host']}.json")) if f != filename]
+        if not files:
+            print("no previous results to compare with")
+            return
+        latest = max(files, key=os.path.getmtime)
+        with open(latest) as f:
+            previous = json.load(f)
+        print(f"compared with {previous['commit']} ({previous['date']})")
+        print(compare(results, previous, args.threshold).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,17 @@
+# =================================================================================================================
+# Description: This script converts the raw data files of a dataset into the columnar store read by
+# bench_allocation.py.
+# The dataset to convert is specified by `dataset` and `level` variables.
+# It only needs to run once per dataset/level; later runs of bench_allocation.py memory-map the store instead of
+# unpickling the nested dicts and parsing the attribute workbook.
+# =================================================================================================================
+from lib_loaddata import convert_to_store
+
+dataset = 'US'  # ["england", "US", "BTH","gd_commute","gd_mobility"]
+level = 'county'  # ["mlad", "msoa", "county", "subdistrict"]
+modified_io = False  # England only, or any dataset with from_units
+from_units = False  # compute dist and io from the unit centroids instead of reading the precomputed tables
+centroid_scale = 1.  # factor applied to projected centroids with from_units, e.g. 0.001 for metres to km
+
+path = convert_to_store(dataset, level, modified_io=modified_io, from_units=from_units, centroid_scale=centroid_scale)
+print(f"======> store written to {path}")
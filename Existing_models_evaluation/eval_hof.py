@@ -0,0 +1,77 @@
+# =================================================================================================================
+# Description: This script scores the hall-of-fame equations of SR runs (the output_file CSVs of SRRegressor) on a
+# dataset, with the per-origin normalization and the metrics of the baseline models in bench_allocation.py.
+# The features of the equations are named as in the Julia drivers (e.g. D, Sr, Sw, Ro, Wo, Rd, Wd for the US and
+# England, see lib_loaddata.JULIA_X). The dataset is loaded once and its columns are memory-mapped by a pool of
+# worker processes, each scoring a contiguous share of the equations (see lib_hof.py). The scores of all equations
+# are written to one table (--output), ranked by CPC within each hall of fame.
+# Example:
+#   python eval_hof.py hof_usacs_county_2406101200.csv --data US:county --jobs 8
+# =================================================================================================================
+from concurrent.futures import ProcessPoolExecutor
+from lib_loaddata import *
+from lib_hof import features_of, parse_equation, read_hof, score_equations
+from lib_laws import init_worker
+import lib_profile
+import argparse
+import shutil
+
+
+@lib_profile.task
+def score_chunk(folder, equations, names):
+    # Scores of the equations (texts) on the arrays shared in folder
+    trees = [parse_equation(e, names) for e in equations]
+    used = set().union(set(), *[features_of(t) for t in trees])
+    arrays = open_arrays(folder, [*used, 'Yarr', 'outflow', 'ori_sep'])
+    return {'scores': score_equations(trees, arrays, arrays['Yarr'], arrays['outflow'], arrays['ori_sep'])}
+
+
+def score_hofs(hof_files, dataset, level, jobs=None, use_store=True):
+    od = load_pairs(dataset, level, use_store)
+    columns = JULIA_X[dataset]
+    hofs = []
+    for f in hof_files:
+        hof = read_hof(f)
+        for i, equation in enumerate(hof['Equation']):  # fail before starting the workers
+            try:
+                parse_equation(equation, columns)
+            except (SyntaxError, ValueError) as e:
+                raise ValueError(f"{f}, row {i}: cannot parse {equation!r}: {e}")
+        hofs.append(hof.assign(hof=f, dataset=dataset, level=level))
+    hofs = pd.concat(hofs, ignore_index=True)
+
+    tmpdir = shared_tempdir("hof_")
+    try:
+        save_arrays(tmpdir, {name: julia_column(od, col) for name, col in columns.items()})
+        save_arrays(tmpdir, {'Yarr': od['flow'], 'outflow': od.outflow, 'ori_sep': od.ori_sep})
+        del od
+        jobs = jobs or os.cpu_count()
+        # contiguous shares of the equations: consecutive entries of a hall of fame share most subexpressions
+        chunks = [c for c in np.array_split(np.arange(len(hofs)), min(jobs, len(hofs))) if len(c)]
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker) as pool:
+            futures = [pool.submit(score_chunk, tmpdir, hofs['Equation'].iloc[c].tolist(), list(columns))
+                       for c in chunks]
+            scores = [s for future in futures for s in lib_profile.merge_task(future.result())['scores']]
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    hofs = pd.concat([hofs, pd.DataFrame(scores)], axis=1)
+    return hofs.sort_values(['hof', 'cpc'], ascending=[True, False])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score hall-of-fame equations of SR runs on a dataset.")
+    parser.add_argument("hof", nargs="+", help="hall-of-fame CSV files (Complexity, Loss, Equation)")
+    parser.add_argument("--data", default="US:county", help="dataset:level the equations are scored on")
+    parser.add_argument("--jobs", type=int, default=None, help="number of worker processes (default: all cores)")
+    parser.add_argument("--no-store", action="store_true", help="read the raw files even if a store exists")
+    parser.add_argument("--output", default="hof_scores.csv", help="table of the scores of all equations")
+    args = parser.parse_args()
+
+    dataset, level = args.data.split(":")
+    results = score_hofs(args.hof, dataset, level, args.jobs, not args.no_store)
+    results.to_csv(args.output, index=False)
+    print(results[['hof', 'Complexity', 'Equation', 'rmse', 'mae', 'cpc']].to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
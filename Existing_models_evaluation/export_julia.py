@@ -0,0 +1,16 @@
+# =================================================================================================================
+# Description: This script exports the SR inputs (X, y and ori_sep) of a dataset to an HDF5 file read by the Julia
+# drivers in ../FlowSR_Julia/symbolic_regression_on_real_data/, instead of building them from the pickles at every run.
+# The dataset to export is specified by `dataset` and `level` variables; the pairs are read from the store written
+# by convert_store.py when it exists, otherwise from the raw files. See lib_loaddata.export_julia for the layout.
+# =================================================================================================================
+from lib_loaddata import export_julia, load_pairs
+import os
+
+dataset = 'US'  # ["england", "US", "BTH","gd_commute","gd_mobility"]
+level = 'county'  # ["mlad", "msoa", "county", "subdistrict"]
+output = f"../Data/julia/{dataset}_{level}.h5"
+
+os.makedirs(os.path.dirname(output), exist_ok=True)
+path = export_julia(load_pairs(dataset, level), dataset, output)
+print(f"======> Julia inputs written to {path}")
@@ -0,0 +1,200 @@
+# =================================================================================================================
+# Description: This file contains the shared machinery for per-origin allocation models.
+# `OriginPartition` splits the OD pairs into origin segments (pairs of origin i are ori_sep[i]:ori_sep[i+1]) and
+# performs the per-origin normalization with vectorized segment reductions.
+# `fit_allocation` fits parametric allocation laws by L-BFGS-B with analytic gradients of the normalized MSE.
+# `resample_weights` gives the origin weights of origin-level bootstrap and k-fold cross-validation resamples.
+# `PairChunks` and `fit_allocation_chunked` fit out of core: the pairs are read in chunks of whole origins (e.g. from
+# the memory-mapped store), the next chunk on a background thread while the current one is evaluated. As the
+# normalization is per origin, the loss and gradient are sums over the chunks, so the memory is bounded by the
+# chunk size rather than by the number of pairs.
+# It is used by ./bench_allocation.py and
+# ../FlowSR_Julia/symbolic_regression_on_synthetic_data/simulate_geo_allocation.py
+# =================================================================================================================
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy import optimize
+from lib_laws import FeatureCache
+from lib_metrics import origin_blocks
+from lib_profile import count, profiled, stage
+
+CHUNK_PAIRS = 2 ** 22  # default number of OD pairs per chunk of PairChunks
+
+
+class OriginPartition:
+    def __init__(self, ori_sep):
+        # ori_sep: [0, n_1, n_1+n_2, ...], the same layout as prepare_data in bench_allocation.py
+        self.ori_sep = np.asarray(ori_sep, dtype=np.int64)
+        self.n_origins = len(self.ori_sep) - 1
+        self.n_pairs = int(self.ori_sep[-1])
+        self.counts = np.diff(self.ori_sep)
+        self.nonempty = self.counts > 0
+        self.starts = self.ori_sep[:-1][self.nonempty]  # reduceat cannot handle empty segments
+
+    def segment_sum(self, x):
+        # Sum of x over the pairs of each origin (0 for origins without pairs)
+        out = np.zeros(self.n_origins, dtype=np.result_type(x, np.float64))
+        if self.n_pairs > 0:
+            out[self.nonempty] = np.add.reduceat(x, self.starts)
+        return out
+
+    def expand(self, v):
+        # Broadcast a per-origin vector to the pairs
+        return np.repeat(v, self.counts)
+
+    def normalize(self, alloc, outflow):
+        # In-place rescaling so that the allocation of each origin sums to its outflow
+        stdfac = self.segment_sum(alloc)
+        fac = np.divide(outflow, stdfac, out=np.zeros_like(stdfac), where=stdfac != 0)
+        alloc *= self.expand(fac)
+        return alloc
+
+    def select(self, origins):
+        # Pair indices of the given origins and the partition of the selected pairs
+        origins = np.asarray(origins, dtype=np.int64)
+        counts = self.counts[origins]
+        sep = np.concatenate(([0], np.cumsum(counts)))
+        idx = np.repeat(self.ori_sep[origins] - sep[:-1], counts) + np.arange(sep[-1])
+        return idx, OriginPartition(sep)
+
+    @profiled
+    def normalized_mse(self, p, Y, outflow, dp=None, weights=None):
+        # MSE between Y and the origin-normalized allocation of the unnormalized probabilities p.
+        # With dp (d p / d param, shape (n_param, n_pairs)) the gradient is returned as well:
+        #   alloc = F p / S, S = sum_o p  =>  dL/dparam = 2/n sum dp * (w - sum_o(w p) / S), w = F / S * (alloc - Y)
+        # weights: optional weight of each origin (e.g. its multiplicity in a bootstrap resample); the pairs of
+        # origin i count weights[i] times, so n becomes sum_i weights[i] * n_i.
+        stdfac = self.segment_sum(p)
+        fac = self.expand(np.divide(outflow, stdfac, out=np.zeros_like(stdfac), where=stdfac != 0))
+        res = p * fac - Y
+        if weights is None:
+            n = len(Y)
+            loss = np.mean(res ** 2)
+            w = fac * res
+        else:
+            n = np.dot(weights, self.counts)
+            omega = self.expand(weights)
+            loss = np.dot(omega, res ** 2) / n
+            w = omega * fac * res
+        if dp is None:
+            return loss
+        c = np.divide(self.segment_sum(w * p), stdfac, out=np.zeros_like(stdfac), where=stdfac != 0)
+        grad = 2 / n * (np.atleast_2d(dp) @ (w - self.expand(c)))
+        return loss, grad
+
+
+@profiled
+def fit_allocation(law, X, Yarr, outflow, partition, init_param=None, bounds=None, batch_size=None, seed=0,
+                   weights=None):
+    # Fit the parameters of an AllocationLaw by L-BFGS-B on the origin-normalized MSE, using its analytic gradient.
+    # X is a FeatureCache or the sequence of the 4 feature columns [dis, io, md, mo] (see ODPairs.features); the
+    # parameter-free terms of the law are computed once and reused by every evaluation. init_param and bounds
+    # default to those of the law.
+    # With batch_size, the parameters are first fitted on a random batch of origins (as the batching of the
+    # SR search), then refined on the full data from there, which needs only a few full-data evaluations. The batch
+    # is drawn from `seed`, so that the fit is reproducible (and can be cached).
+    # weights: optional weight of each origin in the loss (see resample_weights).
+    # Laws without analytic gradient are fitted on the loss alone (finite differences of L-BFGS-B).
+    jac = law.grad_kernels is not None
+
+    def objective(param, cache, Y, F, part, wts):
+        dp = law.evaluate_grad(cache, param) if jac else None
+        return part.normalized_mse(law.evaluate(cache, param), Y, F, dp, wts)
+
+    def iteration(param):
+        count('optimizer_iteration')
+
+    cache = X if isinstance(X, FeatureCache) else FeatureCache(*X)
+    init_param = np.asarray(law.init if init_param is None else init_param, dtype=float)
+    bounds = law.bounds if bounds is None else bounds
+    if batch_size is not None and batch_size < partition.n_origins:
+        rng = np.random.default_rng(seed)
+        origins = np.sort(rng.choice(partition.n_origins, batch_size, replace=False))
+        idx, sub = partition.select(origins)
+        res = optimize.minimize(objective, init_param, args=(cache.subset(idx), Yarr[idx], outflow[origins], sub,
+                                                             None if weights is None else weights[origins]),
+                                jac=jac, method="L-BFGS-B", bounds=bounds, callback=iteration)
+        init_param = res.x
+    return optimize.minimize(objective, init_param, args=(cache, Yarr, outflow, partition, weights), jac=jac,
+                             method="L-BFGS-B", bounds=bounds, callback=iteration)
+
+
+def resample_weights(n_origins, scheme, index, seed=0, n_folds=5):
+    # Origin weights of resample `index` and the mask of its held-out origins (None for the bootstrap).
+    # 'bootstrap': the origins drawn with replacement, weighted by their multiplicity (the draw of resample index
+    #   depends only on (seed, index), so the resamples can run in any order and process);
+    # 'cv': fold `index` of a random split of the origins into n_folds folds is held out (weight 0).
+    if scheme == 'bootstrap':
+        rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(index,)))
+        return np.bincount(rng.integers(0, n_origins, n_origins), minlength=n_origins).astype(np.float64), None
+    if scheme == 'cv':
+        heldout = np.random.default_rng(seed).permutation(n_origins) % n_folds == index
+        return (~heldout).astype(np.float64), heldout
+    raise ValueError(f"Unknown resampling scheme: {scheme}")
+
+
+def prefetched(load, items, depth=1):
+    # load(item) for each item in turn, the next `depth` items being loaded on a background thread meanwhile
+    items = list(items)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        pending = [pool.submit(load, item) for item in items[:depth]]
+        for i in range(len(items)):
+            if i + depth < len(items):
+                pending.append(pool.submit(load, items[i + depth]))
+            yield pending.pop(0).result()
+
+
+class PairChunks:
+    # Chunks of whole origins of a dataset too large for memory. load(s, e) gives the feature columns
+    # [dis, io, md, mo] and the flows of the pairs s:e (e.g. slices of the memory-mapped store, see
+    # ODPairs.features); ori_sep and outflow are those of the whole dataset, in memory.
+    def __init__(self, load, ori_sep, outflow, chunk_pairs=CHUNK_PAIRS, prefetch=1):
+        self.load = load
+        self.ori_sep = np.asarray(ori_sep, dtype=np.int64)
+        self.outflow = np.asarray(outflow, dtype=np.float64)
+        self.blocks = list(origin_blocks(self.ori_sep, chunk_pairs))
+        self.prefetch = prefetch
+        self.n_origins = len(self.ori_sep) - 1
+        self.n_pairs = int(self.ori_sep[-1])
+
+    def chunk(self, block):
+        # Origin range (a, b), FeatureCache, flows, outflows and partition of a block, read into memory
+        a, b = block
+        s, e = self.ori_sep[a], self.ori_sep[b]
+        with stage('read_chunk'):
+            X, Y = self.load(s, e)
+            X, Y = [np.array(x) for x in X], np.array(Y, dtype=np.float64)
+        return (a, b), FeatureCache(*X), Y, self.outflow[a:b], OriginPartition(self.ori_sep[a:b + 1] - s)
+
+    def __iter__(self):
+        return prefetched(self.chunk, self.blocks, self.prefetch)
+
+
+@profiled
+def fit_allocation_chunked(law, chunks, init_param=None, bounds=None, weights=None):
+    # fit_allocation on PairChunks: every evaluation reads the chunks in turn and sums their loss and gradient,
+    # weighted by their number of pairs (sum_i weights[i] * n_i with origin weights, see resample_weights).
+    # Laws without analytic gradient are fitted on the loss alone (finite differences of L-BFGS-B).
+    jac = law.grad_kernels is not None
+
+    def objective(param):
+        loss, grad, n = 0., 0., 0.
+        for (a, b), cache, Y, F, part in chunks:
+            wts = None if weights is None else weights[a:b]
+            m = len(Y) if wts is None else np.dot(wts, part.counts)
+            if m == 0:
+                continue
+            dp = law.evaluate_grad(cache, param) if jac else None
+            out = part.normalized_mse(law.evaluate(cache, param), Y, F, dp, wts)
+            loss += m * (out[0] if jac else out)
+            if jac:
+                grad = grad + m * out[1]
+            n += m
+        return (loss / n, grad / n) if jac else loss / n
+
+    def iteration(param):
+        count('optimizer_iteration')
+
+    init_param = np.asarray(law.init if init_param is None else init_param, dtype=float)
+    bounds = law.bounds if bounds is None else bounds
+    return optimize.minimize(objective, init_param, jac=jac, method="L-BFGS-B", bounds=bounds, callback=iteration)
@@ -0,0 +1,181 @@
+# =================================================================================================================
+# Description: This file contains the persistent cache of fitted allocation laws, shared by ./bench_allocation.py and
+# ../FlowSR_Julia/symbolic_regression_on_synthetic_data/simulate_geo_allocation.py.
+# A fit is stored as one JSON file under FIT_CACHE_DIR, keyed by a content hash of the prepared arrays (features,
+# flows, outflows and ori_sep), the law (its name, expressions, parameters and bounds, so that editing a law
+# invalidates its fits) and the optimizer settings. `cached_fit` returns the stored optimum when the key is found;
+# otherwise it fits starting from the stored optimum of the same law and settings on the most similar data (by a
+# fingerprint of the arrays, e.g. after switching use_work_attr), and stores the result. Only data within
+# WARM_DISTANCE of each other are considered similar: the optimum of another dataset is usually a worse starting
+# point than the default one, and may lead the optimizer to a worse local optimum. The starting points can be
+# restricted to the fits stored before a given time (the start of a run), so that the fits of a run do not depend on
+# the order in which its workers finish.
+# The entries also record where the arrays came from (dataset, level, ..., several sources when the arrays of
+# different datasets are identical), so that the simulator can look up the parameters fitted by the benchmark with
+# `FitCache.find`.
+# =================================================================================================================
+import hashlib
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+import numpy as np
+from scipy import optimize
+from lib_allocation import fit_allocation
+
+FIT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Data", "fit_cache")
+HASH_BLOCK = 2 ** 22  # elements per block when hashing and fingerprinting the arrays
+WARM_DISTANCE = 1.  # largest distance between the fingerprints of the data of a warm start and of its starting point
+LOCK_TIMEOUT = 30.  # seconds after which the lock of an entry is considered left by a dead process
+
+
+def data_signature(X, Yarr, outflow, ori_sep):
+    # Content hash and fingerprint of the prepared arrays (possibly memory-mapped), read block by block.
+    # The fingerprint holds the sizes and the mean and standard deviation of log(1 + |x|) of each column.
+    h = hashlib.blake2b(digest_size=16)
+    fingerprint = [np.log1p(len(Yarr)), np.log1p(len(ori_sep) - 1)]
+    ori_sep = np.asarray(ori_sep, dtype=np.int64) - ori_sep[0]
+    for i, arr in enumerate([*X, Yarr, outflow, ori_sep]):
+        h.update(f"{i}:{np.asarray(arr[:0]).dtype}:{len(arr)};".encode())
+        s1 = s2 = 0.
+        for s in range(0, len(arr), HASH_BLOCK):
+            block = np.ascontiguousarray(arr[s:s + HASH_BLOCK])
+            h.update(memoryview(block).cast('B'))
+            if i <= len(X):  # features and flows
+                v = np.log1p(np.abs(block.astype(np.float64)))
+                s1 += v.sum()
+                s2 += np.dot(v, v)
+        if i <= len(X):
+            mean = s1 / max(len(arr), 1)
+            fingerprint += [mean, np.sqrt(max(s2 / max(len(arr), 1) - mean ** 2, 0.))]
+    return {'data_hash': h.hexdigest(), 'fingerprint': [float(v) for v in fingerprint]}
+
+
+def law_definition(law):
+    # What determines the optimum of a law besides its name, as read back from the files
+    return json.loads(json.dumps({'expr': law.expr, 'params': law.params, 'grad': law.grad_expr,
+                                  'bounds': law.bounds, 'init': law.init}))
+
+
+class FitCache:
+    # Fitted parameters stored as one JSON file per key in `folder`
+    def __init__(self, folder=FIT_CACHE_DIR):
+        self.folder = folder
+
+    @staticmethod
+    def key(data_hash, law, settings):
+        return hashlib.blake2b(json.dumps([data_hash, law.name, law_definition(law), settings],
+                                          sort_keys=True).encode(), digest_size=16).hexdigest()
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self.folder, key + ".json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, entry):
+        # Written to a temporary file first, so that concurrent workers never read a partial entry
+        os.makedirs(self.folder, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.folder, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(entry, f, indent=1)
+        os.replace(tmp, os.path.join(self.folder, key + ".json"))
+
+    @contextmanager
+    def lock(self, key):
+        # Exclusive access to an entry across processes, with a lock file created atomically
+        os.makedirs(self.folder, exist_ok=True)
+        path = os.path.join(self.folder, key + ".lock")
+        start = time.time()
+        while True:
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                if time.time() - start > LOCK_TIMEOUT:
+                    break  # stale lock
+                time.sleep(0.01)
+        try:
+            yield
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def add(self, key, entry):
+        # Store an entry, keeping the sources already recorded under the key (by another process)
+        with self.lock(key):
+            old = self.get(key)
+            if old is not None:
+                new = [s for s in entry['sources'] if s not in old['sources']]
+                entry = dict(entry, sources=old['sources'] + new)
+            self.put(key, entry)
+
+    def add_source(self, key, meta):
+        with self.lock(key):
+            entry = self.get(key)
+            if entry is not None and meta not in entry['sources']:
+                entry['sources'].append(meta)
+                self.put(key, entry)
+
+    def entries(self):
+        if not os.path.isdir(self.folder):
+            return
+        for name in sorted(os.listdir(self.folder)):
+            if name.endswith(".json"):
+                entry = self.get(name[:-5])
+                if entry is not None:
+                    yield entry
+
+    def nearest(self, law, settings, fingerprint, max_distance=WARM_DISTANCE, before=None):
+        # Entry of the same law and settings whose data fingerprint is the closest, None if there is none within
+        # max_distance. before: only the entries stored before this time.time()
+        best, best_dist = None, max_distance
+        definition = law_definition(law)
+        for entry in self.entries():
+            if (entry['model'] != law.name or entry.get('law') != definition or entry['settings'] != settings
+                    or (before is not None and entry['time'] >= before)):
+                continue
+            dist = np.linalg.norm(np.subtract(entry['fingerprint'], fingerprint))
+            if dist < best_dist:
+                best, best_dist = entry, dist
+        return best
+
+    def find(self, law, **meta):
+        # Latest entry of the law (as currently defined) with a source matching the given items
+        # (e.g. dataset='england', level='msoa')
+        definition = law_definition(law)
+        found = [e for e in self.entries() if e['model'] == law.name and e.get('law') == definition
+                 and any(all(source.get(k) == v for k, v in meta.items()) for source in e['sources'])]
+        return max(found, key=lambda e: e['time']) if found else None
+
+
+def cached_fit(fit_cache, law, X, Yarr, outflow, partition, signature, settings=None, meta=None, warm_before=None,
+               **kwargs):
+    # fit_allocation(law, X, Yarr, outflow, partition, **kwargs) through the cache. signature: data_signature of
+    # the arrays; settings: the optimizer settings that change the optimum (e.g. batch_size), JSON-serializable;
+    # meta: description of the data, added to the sources of the entry (see FitCache.find); warm_before: only
+    # warm-start from the fits stored before this time.time() (see FitCache.nearest).
+    # Returns the OptimizeResult (nfev=0 for a stored optimum) and the source of the fit: 'cache', 'warm' or 'cold'.
+    settings = dict(settings or {}, method="L-BFGS-B", bounds=kwargs.get('bounds', law.bounds))
+    settings = json.loads(json.dumps(settings))  # tuples as lists, as read back from the files
+    key = FitCache.key(signature['data_hash'], law, settings)
+    meta = json.loads(json.dumps(meta or {}))
+    entry = fit_cache.get(key)
+    if entry is not None:
+        if meta not in entry['sources']:
+            fit_cache.add_source(key, meta)
+        return optimize.OptimizeResult(x=np.array(entry['param']), fun=entry['loss'], nfev=0, success=True,
+                                       message="stored optimum"), 'cache'
+    near = fit_cache.nearest(law, settings, signature['fingerprint'], before=warm_before)
+    if near is not None:
+        kwargs['init_param'] = near['param']
+    res = fit_allocation(law, X, Yarr, outflow, partition, **kwargs)
+    fit_cache.add(key, {'model': law.name, 'law': law_definition(law), 'settings': settings,
+                        'data_hash': signature['data_hash'], 'fingerprint': signature['fingerprint'],
+                        'sources': [meta], 'param': res.x.tolist(), 'loss': float(res.fun), 'nfev': int(res.nfev),
+                        'time': time.time()})
+    return res, 'cold' if near is None else 'warm'
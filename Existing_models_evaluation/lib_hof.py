@@ -0,0 +1,134 @@
+# =================================================================================================================
+# Description: This file contains the evaluation of hall-of-fame equations found by the SR runs (the output_file CSV
+# of SRRegressor, with columns Complexity, Loss and Equation) on a prepared dataset, used by ./eval_hof.py.
+# An equation is parsed into a tree of whitelisted operations over the named features of X (e.g. D, Sr, Wd, see
+# lib_loaddata.JULIA_X, or x1, x2, ... in column order) and numeric constants; the text is never evaluated.
+# The trees are evaluated with NumPy on whole columns; subexpressions shared by several equations are evaluated once
+# and cached until the last equation using them is scored. As in the SR loss, the result is normalized per origin
+# before computing the metrics.
+# =================================================================================================================
+import ast
+import re
+import numpy as np
+import pandas as pd
+from lib_allocation import OriginPartition
+from lib_metrics import flow_metrics
+
+# Operators of the SR runs (binary_operators/unary_operators of SRRegressor) and a few common others
+BINARY = {ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply, ast.Div: np.divide, ast.Pow: np.power}
+UNARY = {'exp': np.exp, 'log': np.log, 'sqrt': np.sqrt, 'abs': np.abs, 'square': np.square,
+         'cube': lambda x: x ** 3, 'neg': np.negative, 'inv': lambda x: 1 / x, 'sin': np.sin, 'cos': np.cos}
+
+
+def parse_equation(text, names):
+    # Tree of an equation: ('const', value), ('var', name), (unary, child) or (binary op, left, right).
+    # names: feature names in the column order of X (for the x1, x2, ... notation)
+    tree = ast.parse(text.strip().replace('^', '**'), mode='eval').body
+    return _convert(tree, list(names))
+
+
+def _convert(node, names):
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+        return ('const', float(node.value))
+    if isinstance(node, ast.Name):
+        if node.id in names:
+            return ('var', node.id)
+        m = re.fullmatch(r'x(\d+)', node.id)
+        if m and 1 <= int(m.group(1)) <= len(names):
+            return ('var', names[int(m.group(1)) - 1])
+        raise ValueError(f"Unknown feature {node.id}, expected one of {names}")
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.UAdd, ast.USub)):
+        child = _convert(node.operand, names)
+        if isinstance(node.op, ast.UAdd):
+            return child
+        return ('const', -child[1]) if child[0] == 'const' else ('neg', child)
+    if isinstance(node, ast.BinOp) and type(node.op) in BINARY:
+        return (type(node.op).__name__, _convert(node.left, names), _convert(node.right, names))
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in UNARY
+            and len(node.args) == 1 and not node.keywords):
+        return (node.func.id, _convert(node.args[0], names))
+    raise ValueError(f"Unsupported expression: {ast.unparse(node)}")
+
+
+_BINARY_NAMES = {op.__name__: func for op, func in BINARY.items()}
+
+
+def features_of(tree):
+    # Names of the features used by a tree
+    if tree[0] == 'var':
+        return {tree[1]}
+    if tree[0] == 'const':
+        return set()
+    return set().union(*[features_of(child) for child in tree[1:]])
+
+
+def subtrees(tree):
+    # Operation subtrees of a tree (excluding features and constants)
+    if tree[0] in ('var', 'const'):
+        return
+    yield tree
+    for child in tree[1:]:
+        yield from subtrees(child)
+
+
+def shared_subtrees(trees):
+    # Operation subtrees occurring in more than one equation, worth caching
+    counts = dict()
+    for tree in trees:
+        for sub in set(subtrees(tree)):
+            counts[sub] = counts.get(sub, 0) + 1
+    return {sub for sub, n in counts.items() if n > 1}
+
+
+def evaluate_tree(tree, features, cache=None, shared=()):
+    # Values of a tree on the feature columns (dict name -> array); subtrees in `shared` are kept in cache
+    if tree[0] == 'const':
+        return tree[1]
+    if tree[0] == 'var':
+        return features[tree[1]]
+    if cache is not None and tree in cache:
+        return cache[tree]
+    args = [evaluate_tree(child, features, cache, shared) for child in tree[1:]]
+    with np.errstate(all='ignore'):
+        value = _BINARY_NAMES[tree[0]](*args) if tree[0] in _BINARY_NAMES else UNARY[tree[0]](args[0])
+    if cache is not None and tree in shared:
+        cache[tree] = value
+    return value
+
+
+def read_hof(filename):
+    # Hall of fame CSV of SRRegressor as a DataFrame with columns Complexity, Loss and Equation
+    hof = pd.read_csv(filename)
+    hof.columns = [c.strip() for c in hof.columns]
+    return hof
+
+
+def score_equations(trees, features, Yarr, outflow, ori_sep, shared=None):
+    # Metrics of each equation tree (per-origin normalized allocation against Yarr), with the subexpressions shared
+    # by the equations (default: shared_subtrees(trees)) cached across them, each until the last equation using it.
+    # Equations giving non-finite or negative allocations are reported as they are, with the number of such pairs
+    # in 'n_invalid'.
+    shared = shared_subtrees(trees) if shared is None else shared
+    uses = [set(subtrees(tree)) & shared for tree in trees]
+    remaining = dict()  # number of equations still to score using each shared subtree
+    for subs in uses:
+        for sub in subs:
+            remaining[sub] = remaining.get(sub, 0) + 1
+    partition = OriginPartition(ori_sep)
+    n = len(Yarr)
+    cache = dict()
+    results = []
+    for tree, subs in zip(trees, uses):
+        alloc = np.array(np.broadcast_to(evaluate_tree(tree, features, cache, shared), (n,)), dtype=np.float64)
+        with np.errstate(all='ignore'):
+            n_invalid = int(np.count_nonzero(~(alloc >= 0)))
+            partition.normalize(alloc, outflow)
+            result = flow_metrics(Yarr, alloc, ori_sep).result()
+            result['mse'] = float(np.mean((alloc - Yarr) ** 2))
+        result['n_invalid'] = n_invalid
+        results.append(result)
+        for sub in subs:
+            remaining[sub] -= 1
+            if remaining[sub] == 0:
+                cache.pop(sub, None)
+    return results
@@ -0,0 +1,195 @@
+# =================================================================================================================
+# Description: This file contains the registry of allocation laws shared by ./bench_allocation.py and
+# ../FlowSR_Julia/symbolic_regression_on_synthetic_data/simulate_geo_allocation.py.
+# Each law is an expression of the pair features (dis: distance, io: intervening opportunities, md: destination
+# attribute, mo: origin attribute) and its parameters, with the derivatives w.r.t. the parameters, bounds and
+# initial values. The expressions are compiled once at import time with numexpr or numba when available
+# (numpy otherwise); set FLOWSR_LAW_BACKEND to "numexpr", "numba" or "numpy" to choose the backend explicitly.
+# Expressions can also use the parameter-free terms of TERMS (e.g. ldis = log(dis)). A FeatureCache computes each
+# term once per prepared dataset, so that evaluating a law in a fit only costs a few fused exp/multiply passes.
+# A new law only needs a register_law(...) call, e.g.
+#   register_law("custom", "md**0.5127566392825407 / (dis**3 / md + mo)")
+# =================================================================================================================
+import math
+import os
+import re
+import numpy as np
+from lib_profile import profiled, worker_init
+
+FEATURES = ('dis', 'io', 'md', 'mo')
+
+
+def _pick_backend():
+    backend = os.environ.get("FLOWSR_LAW_BACKEND")
+    if backend is not None:
+        return backend
+    for backend in ['numexpr', 'numba']:
+        try:
+            __import__(backend)
+            return backend
+        except ImportError:
+            pass
+    return 'numpy'
+
+
+BACKEND = _pick_backend()
+
+
+def init_worker():
+    # Initializer of the worker processes of a pool: one thread per worker, the pool provides the parallelism
+    worker_init()
+    if BACKEND == 'numexpr':
+        import numexpr
+        numexpr.set_num_threads(1)
+
+
+def compile_expr(expr, params=(), backend=BACKEND, terms=()):
+    # Vectorized function f(dis, io, md, mo, *terms, *params) evaluating `expr`
+    names = FEATURES + tuple(terms) + tuple(params)
+    if backend == 'numexpr':
+        import numexpr
+        numexpr.validate(expr, local_dict={n: 1.0 for n in names})  # fail early on malformed expressions
+
+        def kernel(*args):
+            return numexpr.evaluate(expr, local_dict=dict(zip(names, args)))
+    elif backend == 'numba':
+        import numba
+        namespace = {'exp': math.exp, 'log': math.log, 'where': numba.njit(lambda cond, a, b: a if cond else b)}
+        exec(f"def kernel({', '.join(names)}):\n    return {expr}\n", namespace)
+        kernel = numba.vectorize(namespace['kernel'])
+    elif backend == 'numpy':
+        code = compile(expr, expr, 'eval')
+        namespace = {'exp': np.exp, 'log': np.log, 'where': np.where, '__builtins__': {}}
+
+        def kernel(*args):
+            with np.errstate(divide='ignore', over='ignore', invalid='ignore'):
+                return eval(code, namespace, dict(zip(names, args)))
+    else:
+        raise NotImplementedError(f"Unknown backend {backend}")
+    return kernel
+
+
+# Parameter-free terms available to the law expressions
+TERMS = {'ldis': "log(dis)", 'lmd': "log(md)", 'lmo': "log(mo)", 'la': "log(mo + io)", 'lc': "log(mo + io + md)"}
+TERM_KERNELS = {name: compile_expr(expr) for name, expr in TERMS.items()}
+
+
+def register_term(name, expr):
+    TERMS[name] = expr
+    TERM_KERNELS[name] = compile_expr(expr)
+
+
+class FeatureCache:
+    # Feature columns [dis, io, md, mo] of a prepared dataset and the TERMS computed on them, each on first use
+    def __init__(self, dis, io, md, mo, terms=None):
+        self.features = (dis, io, md, mo)
+        self.terms = dict() if terms is None else dict(terms)
+
+    def __len__(self):
+        return len(self.features[0])
+
+    def __getitem__(self, name):
+        if name not in self.terms:
+            self.terms[name] = TERM_KERNELS[name](*self.features)
+        return self.terms[name]
+
+    def subset(self, idx):
+        # Cache of the pairs idx, with the terms computed so far
+        return FeatureCache(*[f[idx] for f in self.features], terms={n: t[idx] for n, t in self.terms.items()})
+
+
+class AllocationLaw:
+    def __init__(self, name, expr, params=(), grad=None, bounds=None, init=None):
+        # params: parameter names used in expr; grad: one derivative expression per parameter
+        # bounds/init: defaults of the fitter (bounds as in scipy.optimize.minimize)
+        self.name = name
+        self.expr = expr
+        self.params = tuple(params)
+        self.grad_expr = None if grad is None else tuple(grad)
+        self.bounds = bounds
+        self.init = [1.0] * len(self.params) if init is None else list(init)
+        # terms of TERMS used by the expressions, passed to the kernels after the features
+        used = "".join([expr] + list(grad or []))
+        self.terms = tuple(t for t in TERMS if re.search(rf"\b{t}\b", used))
+        self.kernel = compile_expr(expr, self.params, terms=self.terms)
+        self.grad_kernels = None if grad is None else [compile_expr(g, self.params, terms=self.terms) for g in grad]
+
+    def _param_args(self, param):
+        if not self.params:
+            return ()
+        return tuple(np.ravel(param).astype(float))
+
+    def __call__(self, dis, io, md, mo, param=None):
+        return self.evaluate(FeatureCache(dis, io, md, mo), param)
+
+    def grad(self, dis, io, md, mo, param):
+        # d p / d param, shape (n_param, n_pairs)
+        return self.evaluate_grad(FeatureCache(dis, io, md, mo), param)
+
+    @profiled(name='law_evaluate')
+    def evaluate(self, cache, param=None):
+        # Law on the pairs of a FeatureCache, reusing its terms
+        return self.kernel(*cache.features, *[cache[t] for t in self.terms], *self._param_args(param))
+
+    @profiled(name='law_evaluate_grad')
+    def evaluate_grad(self, cache, param):
+        # d p / d param on the pairs of a FeatureCache, shape (n_param, n_pairs)
+        if self.grad_kernels is None:
+            raise NotImplementedError(f"No gradient for allocation law {self.name}")
+        args = cache.features + tuple(cache[t] for t in self.terms) + self._param_args(param)
+        return np.stack([np.broadcast_to(g(*args), (len(cache),)) for g in self.grad_kernels])
+
+
+LAWS = dict()
+ALIASES = dict()
+
+
+def register_law(name, expr, params=(), grad=None, bounds=None, init=None, aliases=()):
+    LAWS[name] = AllocationLaw(name, expr, params, grad, bounds, init)
+    for alias in aliases:
+        ALIASES[alias] = name
+    return LAWS[name]
+
+
+def get_law(name):
+    name = ALIASES.get(name, name)
+    if name not in LAWS:
+        raise NotImplementedError(f"Allocation law {name} is not registered")
+    return LAWS[name]
+
+
+_A = "(mo + io)"
+_C = "(mo + io + md)"
+
+
+def _pow(x, lx):
+    # x**param from the cached logarithm lx = log(x), as x**param where x = 0
+    return f"where({x} > 0, exp(param * {lx}), {x}**param)"
+
+
+def _pow_log(x, lx):
+    # d x**param / d param = x**param * log(x), 0 where x = 0 instead of 0 * -inf
+    return f"where({x} > 0, exp(param * {lx}) * {lx}, 0.)"
+
+
+# (mo + io)**param, (mo + io + md)**param and mo**param, and their derivatives
+_Ap, _ApL = _pow(_A, "la"), _pow_log(_A, "la")
+_Cp, _CpL = _pow(_C, "lc"), _pow_log(_C, "lc")
+_Mp, _MpL = _pow("mo", "lmo"), _pow_log("mo", "lmo")
+
+register_law("GM_Zipf", "md / dis", aliases=["GMZipf"])
+register_law("GM_Pow", "exp(lmd - param * ldis)", ["param"],
+             grad=["-ldis * exp(lmd - param * ldis)"], aliases=["GMPow"])
+register_law("GM_Exp", "exp(lmd - param * dis)", ["param"],
+             grad=["-dis * exp(lmd - param * dis)"], aliases=["GMExp"])
+register_law("RM", f"md / ({_A} * {_C})")
+register_law("ERM", f"({_Cp} - {_Ap}) * (1 + {_Mp}) / ((1 + {_Ap}) * (1 + {_Cp}))",
+             ["param"],
+             grad=[f"(1 + {_Mp}) / ((1 + {_Ap}) * (1 + {_Cp})) * ("
+                   f"{_CpL} - {_ApL} + ({_Cp} - {_Ap}) * ("
+                   f"{_MpL} / (1 + {_Mp}) - {_ApL} / (1 + {_Ap}) - {_CpL} / (1 + {_Cp})))"])
+register_law("IO", "exp(param * io) - exp(param * (io + md))", ["param"],
+             grad=["io * exp(param * io) - (io + md) * exp(param * (io + md))"],
+             bounds=[(-0.15, -0.0001)], init=[-0.001])
+register_law("OPS", f"md / {_C}")
+register_law("custom", "md**0.5127566392825407 / (dis**3 / md + mo)")
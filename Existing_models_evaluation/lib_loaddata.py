@@ -6,23 +6,66 @@ import openpyxl
 import numpy as np
 import pandas as pd
 import pickle
+import os
+import tempfile
 from tqdm import tqdm
+from lib_pairs import ODPairs
+from lib_spatial import pair_features
+from lib_profile import profiled
 
+# Columnar store written once by convert_to_store() and memory-mapped by load_store()
+STORE_DIR = "../Data/store"
+# Unit attributes kept in the store for each dataset (same selection as bench_allocation.py)
+STORE_FEAT = {'england': ['respop', 'workpop'], 'US': ['respop', 'workpop'], 'BTH': ['pop_wan'],
+              'gd_commute': ['home_pop', 'work_pop'], 'gd_mobility': ['pop']}
+# Column (1-based) of each attribute in the attribute workbooks
+ATTR_FEAT = {'england': {'msoa': {'area_km2': 3, 'respop': 4, 'employedpop': 5, 'workpop': 6, 'households': 7,
+                                  'fb_pct': 8, 'deprived_pct': 9, 'nonwhite_pct': 10, 'bach_pct': 11,
+                                  'highsc_pct': 12},
+                         'mlad': {'respop': 4, 'workpop': 5}},
+             'US': {'county': {'respop': 4, 'employedpop': 5, 'workpop': 6}},
+             'BTH': {'county': {'area_km2': 8, 'pop_wan': 9, 'gdp_yi': 10}}}
+# Census region (1: Northeast, 2: Midwest, 3: South, 4: West) of each state FIPS code (GEOID // 1000), as in
+# ../FlowSR_Julia/geographical_heterogeneity_analysis/srflow_us_sphet_4groups.jl
+US_REGION_STATE = {42: 1, 50: 1, 25: 1, 33: 1, 9: 1, 34: 1, 23: 1, 44: 1, 36: 1,
+                   31: 2, 46: 2, 18: 2, 17: 2, 19: 2, 39: 2, 55: 2, 29: 2, 26: 2, 20: 2, 27: 2, 38: 2,
+                   53: 4, 35: 4, 8: 4, 49: 4, 56: 4, 32: 4, 30: 4, 4: 4, 41: 4, 16: 4, 6: 4,
+                   21: 3, 13: 3, 5: 3, 28: 3, 47: 3, 45: 3, 1: 3, 37: 3, 40: 3, 51: 3, 54: 3, 22: 3, 12: 3, 10: 3,
+                   48: 3, 24: 3, 11: 3}
+# Groupings of the units derived from their ids (see unit_groups)
+UNIT_GROUPINGS = {'us_region': lambda ids: [US_REGION_STATE[i // 1000] for i in ids],
+                  'us_state': lambda ids: [i // 1000 for i in ids]}
+
+# Columns of X in the Julia drivers (../FlowSR_Julia/symbolic_regression_on_real_data/srflow_*.jl), see export_julia:
+# name -> pair column, or (unit attribute, 'ori'/'dest') for the attribute of the origin/destination
+JULIA_X = {'england': {'D': 'dist', 'Sr': 'iores', 'Sw': 'iowork', 'Ro': ('respop', 'ori'), 'Wo': ('workpop', 'ori'),
+                       'Rd': ('respop', 'dest'), 'Wd': ('workpop', 'dest')},
+           'BTH': {'D': 'dist', 'S': 'iores', 'Wo': ('pop_wan', 'ori'), 'Wd': ('pop_wan', 'dest')},
+           'gd_commute': {'Dist': 'dist', 'Oppo_work': 'iowork', 'Oppo_res': 'iores', 'Ohome': ('home_pop', 'ori'),
+                          'Owork': ('work_pop', 'ori'), 'Dhome': ('home_pop', 'dest'), 'Dwork': ('work_pop', 'dest')},
+           'gd_mobility': {'Dist': 'dist', 'Oppor': 'iores', 'Opop': ('pop', 'ori'), 'Dpop': ('pop', 'dest')}}
+JULIA_X['US'] = JULIA_X['england']
+JULIA_CHUNK = 2 ** 20  # pairs per HDF5 chunk
+
+# parsers of the raw files, traced as stages of their own (see lib_profile.py)
+_unpickle = profiled(pickle.load, name='unpickle')
+_load_workbook = profiled(openpyxl.load_workbook, name='load_workbook')
+_read_csv = profiled(pd.read_csv, name='read_csv')
+_read_excel = profiled(pd.read_excel, name='read_excel')
+
+
+@profiled
 def load_england_data_files(level='mlad', select_feat=None, modified_io=False):
     # feat: dist, o, d
-    if level == 'msoa':
-        feat = {'area_km2': 3, 'respop': 4, 'employedpop': 5, 'workpop': 6, 'households':7,
-            'fb_pct': 8, 'deprived_pct': 9, 'nonwhite_pct': 10, 'bach_pct': 11, 'highsc_pct': 12}
-    elif level == 'mlad':
-        feat = {'respop': 4, 'workpop': 5}
+    feat = ATTR_FEAT['england'][level]
     flow_file = open(f"../Data/England/England_{level}_census11_supp3.pkl", 'rb')
-    flow_dict = pickle.load(flow_file)
+    flow_dict = _unpickle(flow_file)
     dist_file = open(f"../Data/England/England_{level}_dist.pkl", 'rb')
-    dist_dict = pickle.load(dist_file)
+    dist_dict = _unpickle(dist_file)
 
     units = list(dist_dict.keys())
     geoid2row = dict()
-    attrdata = openpyxl.load_workbook(f"../Data/England/England_{level}_census11_attr.xlsx")
+    attrdata = _load_workbook(f"../Data/England/England_{level}_census11_attr.xlsx")
     attrtab = attrdata['attr']
     for r in range(2, attrtab.max_row + 1):
         geoid2row[int(attrtab.cell(r, 1).value[-6:])] = r
@@ -36,39 +79,40 @@ def load_england_data_files(level='mlad', select_feat=None, modified_io=False):
 
     if modified_io and level == 'mlad':
         iores_file = open(f"../Data/England/England_{level}_miores.pkl", 'rb')
-        iores_dict = pickle.load(iores_file)
+        iores_dict = _unpickle(iores_file)
         iowork_file = open(f"../Data/England/England_{level}_miowork.pkl", 'rb')
-        iowork_dict = pickle.load(iowork_file)
+        iowork_dict = _unpickle(iowork_file)
     else:
         iores_file = open(f"../Data/England/England_{level}_iores.pkl", 'rb')
-        iores_dict = pickle.load(iores_file)
+        iores_dict = _unpickle(iores_file)
         iowork_file = open(f"../Data/England/England_{level}_iowork.pkl", 'rb')
-        iowork_dict = pickle.load(iowork_file)
-        if modified_io and level == 'msoa':
+        iowork_dict = _unpickle(iowork_file)
+        if modified_io and level == 'msoa':  # add the population of the origin itself
             for o in iores_dict.keys():
-                for d in iores_dict[o].keys():
-                    iores_dict[o][d] += attrtab.cell(geoid2row[o], feat["respop"]).value
-                    iowork_dict[o][d] += attrtab.cell(geoid2row[o], feat["workpop"]).value
+                respop = attrtab.cell(geoid2row[o], feat["respop"]).value
+                workpop = attrtab.cell(geoid2row[o], feat["workpop"]).value
+                iores_dict[o] = {d: v + respop for d, v in iores_dict[o].items()}
+                iowork_dict[o] = {d: v + workpop for d, v in iowork_dict[o].items()}
     return flow_dict, dist_dict, iores_dict, iowork_dict, attr_dict
 
+@profiled
 def load_us_data_files(level='county', select_feat=None):
     # feat: dist, o, d
-    if level == 'county':
-        feat = {'respop': 4, 'employedpop': 5, 'workpop': 6}
-    else:
+    if level not in ATTR_FEAT['US']:
         raise NotImplementedError
+    feat = ATTR_FEAT['US'][level]
 
     flow_file = open(f"../Data/US/us_acs15_{level}_flow.pkl", 'rb')
-    flow_dict = pickle.load(flow_file)
+    flow_dict = _unpickle(flow_file)
     dist_file = open(f"../Data/US/us_{level}_dist.pkl", 'rb')
-    dist_dict = pickle.load(dist_file)
+    dist_dict = _unpickle(dist_file)
     iores_file = open(f"../Data/US/us_{level}_iores.pkl", 'rb')
     iowork_file = open(f"../Data/US/us_{level}_iowork.pkl", 'rb')
-    iores_dict = pickle.load(iores_file)
-    iowork_dict = pickle.load(iowork_file)
+    iores_dict = _unpickle(iores_file)
+    iowork_dict = _unpickle(iowork_file)
     msoa_units = list(dist_dict.keys())
     geoid2row = dict()
-    attrdata = openpyxl.load_workbook(f"../Data/US/us_acs15_{level}_attr.xlsx")
+    attrdata = _load_workbook(f"../Data/US/us_acs15_{level}_attr.xlsx")
     attrtab = attrdata['attr']
     for r in range(2, attrtab.max_row + 1):
         geoid2row[int(attrtab.cell(r, 1).value)] = r
@@ -81,20 +125,20 @@ def load_us_data_files(level='county', select_feat=None):
         attr_dict[o] = attr
     return flow_dict, dist_dict, iores_dict, iowork_dict, attr_dict
 
+@profiled
 def load_bth_data_files(level='county', select_feat=None):
-    if level == 'county':
-        feat = {'area_km2': 8, 'pop_wan': 9, 'gdp_yi': 10}
-    else:
+    if level not in ATTR_FEAT['BTH']:
         raise NotImplementedError
+    feat = ATTR_FEAT['BTH'][level]
     flow_file = open(f"../Data/BTH/BTH_{level}_flow.pkl", 'rb')
-    flow_dict = pickle.load(flow_file)
+    flow_dict = _unpickle(flow_file)
     dist_file = open(f"../Data/BTH/BTH_{level}_dist.pkl", 'rb')
-    dist_dict = pickle.load(dist_file)
+    dist_dict = _unpickle(dist_file)
     io_file = open(f"../Data/BTH/BTH_{level}_io.pkl", 'rb')
-    io_dict = pickle.load(io_file)
+    io_dict = _unpickle(io_file)
     units = list(dist_dict.keys())
     geoid2row = dict()
-    attrdata = openpyxl.load_workbook(f"../Data/BTH/BTH_{level}_attr.xlsx")
+    attrdata = _load_workbook(f"../Data/BTH/BTH_{level}_attr.xlsx")
     attrtab = attrdata['attr']
     for r in range(2, attrtab.max_row + 1):
         geoid2row[int(attrtab.cell(r, 5).value)] = r
@@ -107,112 +151,410 @@ def load_bth_data_files(level='county', select_feat=None):
         attr_dict[o] = attr
     return flow_dict, dist_dict, io_dict, attr_dict
 
-def load_gd_commute_data(select_feat=None, level='subdistrict'):
-    import numpy as np
-    import pandas as pd
-    import pickle
-
-    # Load the raw data
-    flow_array = np.load(r"..\GD_data\Commuting_{}\gd_commute_flow_matrix_inter{}.npy".format(level,level))
-    with open(r"..\GD_data\Commuting_{}\gd_commute_ids_mapping_inter{}.pkl".format(level,level), "rb") as file:
-        id_dict = pickle.load(file)
-    dist_df = pd.read_csv(r"..\GD_data\Commuting_{}\gd_commute_dist_inter{}.csv".format(level,level))
-    attr_df = pd.read_csv(r"..\GD_data\Commuting_{}\gd_commute_attr_inter{}.csv".format(level,level))
-    oppo_df_res = pd.read_csv(r"..\GD_data\Commuting_{}\gd_commute_opportunity_inter{}_res.csv".format(level,level))
-    oppo_df_work = pd.read_csv(r"..\GD_data\Commuting_{}\gd_commute_opportunity_inter{}_work.csv".format(level,level))
+
+def _gather_pairs(df, value_col, id_index, ori, dest):
+    # Gather the values of a long-format (o_id, d_id, value) table at the CSR pairs (ori, dest); the rows of ids
+    # that are not units of the flow matrix are ignored
+    n = len(id_index)
+    o_idx = id_index.get_indexer(df['o_id']).astype(np.int64)
+    d_idx = id_index.get_indexer(df['d_id']).astype(np.int64)
+    rows = np.flatnonzero((o_idx >= 0) & (d_idx >= 0))  # get_indexer gives -1 for unknown ids
+    key = o_idx[rows] * n + d_idx[rows]
+    order = rows[np.argsort(key, kind='stable')]
+    key = o_idx[order] * n + d_idx[order]
+    target = ori.astype(np.int64) * n + dest
+    pos = np.searchsorted(key, target)
+    found = pos < len(key)
+    found[found] = key[pos[found]] == target[found]
+    if not found.all():
+        raise ValueError(f"`{value_col}` is missing for some OD pairs with nonzero flow")
+    return df[value_col].to_numpy(dtype=float)[order[pos]]
+
+
+@profiled
+def _load_gd_csr(flow_file, id_file, dist_file, attr_file, oppo_files, select_feat, level, dtype=np.float64):
+    # Sparse CSR representation of a Guangdong dataset as an ODPairs table:
+    #   pairs: nonzero off-diagonal flows ordered by origin (ori_sep is the CSR indptr, dest the CSR indices),
+    #          with dist and opportunity values gathered at the same pairs
+    #   units: unit ids in the row order of the flow matrix and their attributes
+    flow_array = np.load(flow_file)
+    with open(id_file, "rb") as file:
+        id_dict = _unpickle(file)
+    attr_df = _read_csv(attr_file)
     # Check whether the selected features exist
     if select_feat and not set(select_feat).issubset(attr_df.columns):
         missing_feats = set(select_feat) - set(attr_df.columns)
         raise ValueError(f"Features {missing_feats} not found in the dataset")
 
-    # Transform the DataFrame to a more efficient lookup structure
-    pivot_df = dist_df.pivot(index='o_id', columns='d_id', values='geodesic_dist')
-    dist_dict = pivot_df.to_dict(orient='index')
-    print("======> dist dict loaded")
-    pivot_df = oppo_df_res.pivot(index='o_id', columns='d_id', values='opportunity')
-    oppo_dict_res = pivot_df.to_dict(orient='index')
-    print("======> oppo dict res loaded")
-    pivot_df = oppo_df_work.pivot(index='o_id', columns='d_id', values='opportunity')
-    oppo_dict_work = pivot_df.to_dict(orient='index')
-    print("======> oppo dict work loaded")
-    # Initialize the dictionaries
-    flow_dict = {o_id: {} for o_id in id_dict.values()}
-    attr_dict = {}
-
-    for i in range(flow_array.shape[0]):
-        o_id = id_dict[i]
-
-        # Specify id column based on the level
-        if level == 'subdistrict':
-            id_col = 'street_num'
-        elif level == "county":
-            id_col = "county"
-        
-        if select_feat is None:
-            attr_dict[o_id] = attr_df[attr_df[id_col] == o_id].iloc[0].values[1:]
-        else:
-            attr_dict[o_id] = attr_df[attr_df[id_col] == o_id].iloc[0][select_feat].values
-        
-        # Drop the origin if there is no flow
-        if flow_array[i].sum() == 0:
-            flow_dict.pop(o_id)
+    n = flow_array.shape[0]
+    unit_ids = [id_dict[i] for i in range(n)]
+    id_index = pd.Index(unit_ids)
+    mask = flow_array != 0
+    np.fill_diagonal(mask, False)  # Exclude the flow from the origin to itself
+    ori, dest = np.nonzero(mask)
+    pairs = {'flow': flow_array[ori, dest].astype(dtype)}
+    del mask
+
+    dist_df = _read_csv(dist_file, usecols=['o_id', 'd_id', 'geodesic_dist'])
+    pairs['dist'] = _gather_pairs(dist_df, 'geodesic_dist', id_index, ori, dest).astype(dtype)
+    del dist_df
+    print("======> dist loaded")
+    for name, oppo_file in oppo_files.items():
+        oppo_df = _read_csv(oppo_file, usecols=['o_id', 'd_id', 'opportunity'])
+        pairs[name] = _gather_pairs(oppo_df, 'opportunity', id_index, ori, dest).astype(dtype)
+        print(f"======> {name} loaded")
+
+    # Specify id column based on the level
+    if level == 'subdistrict':
+        id_col = 'street_num'
+    elif level == "county":
+        id_col = "county"
+    else:
+        raise NotImplementedError
+    if select_feat is None:
+        select_feat = list(attr_df.columns[1:])
+    attr_df = attr_df.drop_duplicates(id_col).set_index(id_col).reindex(id_index)
+    units = {'id': np.asarray(unit_ids)}
+    for feat in select_feat:
+        units[feat] = attr_df[feat].to_numpy()
+    return ODPairs(ori, dest, pairs, units)
+
+
+def _csr_to_dicts(od, io_names):
+    # Nested dicts (the format of the other loaders) restricted to origins and OD pairs with nonzero flow
+    unit_ids = od.units['id'].tolist()
+    ori_sep, dest = od.ori_sep, od.dest.tolist()
+    flow_dict = dict()
+    dist_dict = dict()
+    io_dicts = [dict() for name in io_names]
+    for i, o_id in enumerate(unit_ids):
+        s, e = ori_sep[i], ori_sep[i + 1]
+        if s == e:  # Drop the origin if there is no flow
             continue
-        for j in range(flow_array.shape[1]):
-            d_id = id_dict[j]
-            if i != j and flow_array[i,j]!=0:  # Exclude the flow from the origin to itself
-                flow_dict[o_id][d_id] = flow_array[i, j]
+        d_ids = [unit_ids[j] for j in dest[s:e]]
+        flow_dict[o_id] = dict(zip(d_ids, od['flow'][s:e].tolist()))
+        dist_dict[o_id] = dict(zip(d_ids, od['dist'][s:e].tolist()))
+        for name, io_dict in zip(io_names, io_dicts):
+            io_dict[o_id] = dict(zip(d_ids, od[name][s:e].tolist()))
+    feats = [f for f in od.units if f != 'id']
+    attr_mat = np.column_stack([od.units[f] for f in feats])
+    attr_dict = dict(zip(unit_ids, attr_mat))
+    return flow_dict, dist_dict, io_dicts, attr_dict
+
+
+def load_gd_commute_data(select_feat=None, level='subdistrict', csr=False, dtype=np.float64):
+    # csr=True returns the ODPairs table of _load_gd_csr, otherwise nested dicts like the other loaders
+    od = _load_gd_csr(
+        r"..\GD_data\Commuting_{}\gd_commute_flow_matrix_inter{}.npy".format(level,level),
+        r"..\GD_data\Commuting_{}\gd_commute_ids_mapping_inter{}.pkl".format(level,level),
+        r"..\GD_data\Commuting_{}\gd_commute_dist_inter{}.csv".format(level,level),
+        r"..\GD_data\Commuting_{}\gd_commute_attr_inter{}.csv".format(level,level),
+        {'iores': r"..\GD_data\Commuting_{}\gd_commute_opportunity_inter{}_res.csv".format(level,level),
+         'iowork': r"..\GD_data\Commuting_{}\gd_commute_opportunity_inter{}_work.csv".format(level,level)},
+        select_feat, level, dtype)
+    if csr:
+        return od
+    flow_dict, dist_dict, (oppo_dict_res, oppo_dict_work), attr_dict = _csr_to_dicts(od, ['iores', 'iowork'])
     return flow_dict, dist_dict, oppo_dict_res, oppo_dict_work, attr_dict
 
-def load_gd_mobility_data(select_feat=None, level='subdistrict'):
-    import numpy as np
-    import pandas as pd
-    import pickle
-
-    # Load the raw data
-    flow_array = np.load(r"..\GD_data\Mobility_{}\gd_mobility_flow_matrix_inter{}.npy".format(level,level))
-    with open(r"..\GD_data\Mobility_{}\gd_mobility_ids_mapping_inter{}.pkl".format(level,level), "rb") as file:
-        id_dict = pickle.load(file)
-    dist_df = pd.read_csv(r"..\GD_data\Mobility_{}\gd_mobility_dist_inter{}.csv".format(level,level))
-    attr_df = pd.read_csv(r"..\GD_data\Mobility_{}\gd_mobility_attr_inter{}.csv".format(level,level))
-    oppo_df = pd.read_csv(r"..\GD_data\Mobility_{}\gd_mobility_opportunity_inter{}.csv".format(level,level))
-    
-    # Check whether the selected features exist
-    if select_feat and not set(select_feat).issubset(attr_df.columns):
-        missing_feats = set(select_feat) - set(attr_df.columns)
-        raise ValueError(f"Features {missing_feats} not found in the dataset")
 
-    # Transform the DataFrame to a more efficient lookup structure
-    pivot_df = dist_df.pivot(index='o_id', columns='d_id', values='geodesic_dist')
-    dist_dict = pivot_df.to_dict(orient='index')
-    print("======> dist dict loaded")
-    pivot_df = oppo_df.pivot(index='o_id', columns='d_id', values='opportunity')
-    oppo_dict = pivot_df.to_dict(orient='index')
-    print("======> oppo dict loaded")
-    
-    # Initialize the dictionaries
-    flow_dict = {o_id: {} for o_id in id_dict.values()}
-    attr_dict = {}
-
-    for i in range(flow_array.shape[0]):
-        o_id = id_dict[i]
-        
-        # Specify id column based on the level
-        if level == 'subdistrict':
-            id_col = 'street_num'
-        elif level == "county":
-            id_col = "county"
-        
-        if select_feat is None:
-            attr_dict[o_id] = attr_df[attr_df[id_col] == o_id].iloc[0].values[1:]
-        else:
-            attr_dict[o_id] = attr_df[attr_df[id_col] == o_id].iloc[0][select_feat].values
-        
-        if flow_array[i].sum() == 0:
-            flow_dict.pop(o_id)
-            continue
-        for j in range(flow_array.shape[1]):
-            d_id = id_dict[j]
-            if i != j and flow_array[i,j]!=0:  # Exclude the flow from the origin to itself
-                flow_dict[o_id][d_id] = flow_array[i, j]
-                
+def load_gd_mobility_data(select_feat=None, level='subdistrict', csr=False, dtype=np.float64):
+    # csr=True returns the ODPairs table of _load_gd_csr, otherwise nested dicts like the other loaders
+    od = _load_gd_csr(
+        r"..\GD_data\Mobility_{}\gd_mobility_flow_matrix_inter{}.npy".format(level,level),
+        r"..\GD_data\Mobility_{}\gd_mobility_ids_mapping_inter{}.pkl".format(level,level),
+        r"..\GD_data\Mobility_{}\gd_mobility_dist_inter{}.csv".format(level,level),
+        r"..\GD_data\Mobility_{}\gd_mobility_attr_inter{}.csv".format(level,level),
+        {'iores': r"..\GD_data\Mobility_{}\gd_mobility_opportunity_inter{}.csv".format(level,level)},
+        select_feat, level, dtype)
+    if csr:
+        return od
+    flow_dict, dist_dict, (oppo_dict,), attr_dict = _csr_to_dicts(od, ['iores'])
     return flow_dict, dist_dict, oppo_dict, attr_dict
+
+
+def load_data_files(dataset, level, select_feat=None, modified_io=False):
+    # Dispatch to the loader of `dataset`; iowork is None for datasets with a single io table
+    if dataset == 'england':
+        return load_england_data_files(level=level, select_feat=select_feat, modified_io=modified_io)
+    elif dataset == 'US':
+        return load_us_data_files(level=level, select_feat=select_feat)
+    elif dataset == 'BTH':
+        flow_dict, dist_dict, io_dict, attr_dict = load_bth_data_files(level=level, select_feat=select_feat)
+        return flow_dict, dist_dict, io_dict, None, attr_dict
+    elif dataset == 'gd_commute':
+        return load_gd_commute_data(select_feat=select_feat, level=level)
+    elif dataset == 'gd_mobility':
+        flow_dict, dist_dict, oppo_dict, attr_dict = load_gd_mobility_data(select_feat=select_feat, level=level)
+        return flow_dict, dist_dict, oppo_dict, None, attr_dict
+    else:
+        raise NotImplementedError
+
+
+def _gd_file(dataset, level, name):
+    kind = 'Commuting' if dataset == 'gd_commute' else 'Mobility'
+    return r"..\GD_data\{}_{}\{}_{}_inter{}".format(kind, level, dataset, name, level)
+
+
+@profiled
+def load_attr_table(dataset, level):
+    # Attribute table of the units as a DataFrame indexed by unit id, with the header columns of the file (including
+    # the centroids) and, for the workbooks, the attributes of ATTR_FEAT under their names
+    if dataset in ['gd_commute', 'gd_mobility']:
+        attr_df = _read_csv(_gd_file(dataset, level, "attr") + ".csv")
+        id_col = 'street_num' if level == 'subdistrict' else 'county'
+        return attr_df.drop_duplicates(id_col).set_index(id_col)
+    if dataset == 'england':
+        attr_file, id_col, parse = f"../Data/England/England_{level}_census11_attr.xlsx", 1, lambda v: int(v[-6:])
+    elif dataset == 'US':
+        attr_file, id_col, parse = f"../Data/US/us_acs15_{level}_attr.xlsx", 1, int
+    elif dataset == 'BTH':
+        attr_file, id_col, parse = f"../Data/BTH/BTH_{level}_attr.xlsx", 5, int
+    else:
+        raise NotImplementedError
+    attr_df = _read_excel(attr_file, sheet_name='attr')
+    attr_df.index = [parse(v) for v in attr_df.iloc[:, id_col - 1]]
+    for feat, col in ATTR_FEAT[dataset][level].items():
+        attr_df[feat] = attr_df.iloc[:, col - 1]
+    return attr_df
+
+
+@profiled
+def load_centroids(dataset, level, unit_ids, attr_df=None):
+    # Unit centroids from the attribute table, in the order of unit_ids: projected (centx, centy) or geographic
+    # (lon, lat) columns. Returns (xy, geographic)
+    if attr_df is None:
+        attr_df = load_attr_table(dataset, level)
+    for cols, geographic in [(['centx', 'centy'], False), (['lon', 'lat'], True)]:
+        if set(cols).issubset(attr_df.columns):
+            return attr_df.loc[list(unit_ids), cols].to_numpy(dtype=float), geographic
+    raise ValueError(f"No centroid columns (centx/centy or lon/lat) in the attribute table of {dataset} {level}")
+
+
+def unit_groups(dataset, level, unit_ids, grouping, attr_df=None):
+    # Group label of each unit, in the order of unit_ids: a grouping of UNIT_GROUPINGS, or else a column of the
+    # attribute table
+    if grouping in UNIT_GROUPINGS:
+        return np.asarray(UNIT_GROUPINGS[grouping]([int(u) for u in unit_ids]))
+    if attr_df is None:
+        attr_df = load_attr_table(dataset, level)
+    if grouping not in attr_df.columns:
+        raise ValueError(f"Unknown grouping {grouping}: not in UNIT_GROUPINGS nor in the attribute table")
+    return attr_df.loc[list(unit_ids), grouping].to_numpy()
+
+
+@profiled
+def pairs_from_units(dataset, level, select_feat=None, modified_io=False, centroid_scale=1., jobs=None,
+                     dtype=np.float64):
+    # ODPairs table of a dataset read from the flows and the attribute table only: dist and iores(/iowork) are
+    # computed from the unit centroids (see lib_spatial.pair_features) instead of the precomputed N² tables.
+    # iores/iowork count the 1st/2nd attribute of STORE_FEAT[dataset] as opportunities; modified_io adds the
+    # population of the origin itself. Projected centroids are multiplied by centroid_scale (e.g. 0.001 for km).
+    if select_feat is None:
+        select_feat = STORE_FEAT[dataset]
+    attr_df = load_attr_table(dataset, level)
+    if dataset in ['gd_commute', 'gd_mobility']:
+        flow_array = np.load(_gd_file(dataset, level, "flow_matrix") + ".npy")
+        with open(_gd_file(dataset, level, "ids_mapping") + ".pkl", "rb") as file:
+            id_dict = _unpickle(file)
+        unit_ids = [id_dict[i] for i in range(flow_array.shape[0])]
+        mask = flow_array != 0
+        np.fill_diagonal(mask, False)
+        ori, dest = np.nonzero(mask)
+        flow = flow_array[ori, dest]
+    else:
+        if dataset == 'england':
+            flow_file = f"../Data/England/England_{level}_census11_supp3.pkl"
+        elif dataset == 'US':
+            flow_file = f"../Data/US/us_acs15_{level}_flow.pkl"
+        else:
+            flow_file = f"../Data/BTH/BTH_{level}_flow.pkl"
+        with open(flow_file, "rb") as file:
+            flow_dict = _unpickle(file)
+        unit_ids = list(attr_df.index)
+        uid = {u: i for i, u in enumerate(unit_ids)}
+        ori = np.asarray([uid[o] for o, row in flow_dict.items() for d in row], dtype=np.int64)
+        dest = np.asarray([uid[d] for o, row in flow_dict.items() for d in row], dtype=np.int64)
+        flow = np.asarray([vol for row in flow_dict.values() for vol in row.values()], dtype=float)
+        order = np.argsort(ori, kind='stable')  # by origin, destinations in the order of flow_dict[o]
+        ori, dest, flow = ori[order], dest[order], flow[order]
+
+    attr_df = attr_df.reindex(unit_ids)
+    units = {'id': np.asarray(unit_ids)}
+    for feat in select_feat:
+        units[feat] = attr_df[feat].to_numpy(dtype=float)
+    xy, geographic = load_centroids(dataset, level, unit_ids, attr_df)
+    if not geographic:
+        xy = xy * centroid_scale
+    masses = dict(zip(['iores', 'iowork'], [attr_df[f].to_numpy(dtype=float) for f in STORE_FEAT[dataset]]))
+    columns = {'flow': flow.astype(dtype)}
+    columns.update(pair_features(xy, ori, dest, masses, geographic, modified_io, jobs, dtype))
+    return ODPairs(ori, dest, columns, units)
+
+
+def store_path(dataset, level, modified_io=False, store_dir=STORE_DIR):
+    name = f"{dataset}_{level}_mio" if modified_io else f"{dataset}_{level}"
+    return os.path.join(store_dir, name)
+
+
+@profiled
+def pairs_from_dicts(flow, dist, iores, iowork, attr, select_feat, units=None, complete=False, dtype=np.float64):
+    # ODPairs table (the format of _load_gd_csr and load_store) from the nested dicts of the loaders.
+    # Origins follow `units` (default: dist.keys()) and destinations follow flow[o].keys(), as in
+    # bench_allocation.prepare_data. With complete=True every origin is paired with all other units in `units`
+    # order (flow 0 where there is none), as used by the synthetic flow generator; iores/iowork may be None.
+    if units is None:
+        units = list(dist.keys())
+    uid = {u: i for i, u in enumerate(units)}
+    if complete:
+        dests = lambda o: [d for d in units if d != o]
+    else:
+        dests = lambda o: flow.get(o, {}).keys()
+    npair = len(units) * (len(units) - 1) if complete else sum(len(flow.get(o, {})) for o in units)
+    io_dicts = {name: io for name, io in [('iores', iores), ('iowork', iowork)] if io is not None}
+
+    ori = np.empty(npair, dtype=np.int32)
+    dest = np.empty(npair, dtype=np.int32)
+    pairs = {c: np.empty(npair, dtype=dtype) for c in ['flow', 'dist', *io_dicts]}
+    outflow = np.zeros(len(units))
+    k = 0
+    for i, o in enumerate(tqdm(units)):
+        flow_o = flow.get(o, {})
+        outflow[i] = sum(flow_o.values())
+        for d in dests(o):
+            ori[k] = i
+            dest[k] = uid[d]
+            pairs['flow'][k] = flow_o.get(d, 0)
+            pairs['dist'][k] = dist[o][d]
+            for name, io in io_dicts.items():
+                pairs[name][k] = io[o][d]
+            k += 1
+    unit_table = {'id': np.asarray(units)}
+    for f, feat in enumerate(select_feat):
+        unit_table[feat] = np.asarray([attr[o][f] for o in units], dtype=float)
+    return ODPairs(ori, dest, pairs, unit_table, outflow=outflow)
+
+
+@profiled
+def convert_to_store(dataset, level, select_feat=None, modified_io=False, store_dir=STORE_DIR, dtype=np.float64,
+                     from_units=False, centroid_scale=1.):
+    # One-time conversion of a dataset into a columnar store (see ODPairs.save), with from_units from the flows and
+    # the attribute table only (see pairs_from_units):
+    #   ori/dest: int32 indices into the unit table, flow/dist/iores(/iowork): pair columns in `dtype`,
+    #   ori_sep: pairs of origin i are ori_sep[i]:ori_sep[i+1], outflow: total flow of each origin,
+    #   unit_*: unit table (id + attributes)
+    if select_feat is None:
+        select_feat = STORE_FEAT[dataset]
+    if from_units:
+        od = pairs_from_units(dataset, level, select_feat, modified_io, centroid_scale, dtype=dtype)
+    elif dataset == 'gd_commute':
+        od = load_gd_commute_data(select_feat=select_feat, level=level, csr=True, dtype=dtype)
+    elif dataset == 'gd_mobility':
+        od = load_gd_mobility_data(select_feat=select_feat, level=level, csr=True, dtype=dtype)
+    else:
+        od = pairs_from_dicts(*load_data_files(dataset, level, select_feat, modified_io), select_feat, dtype=dtype)
+
+    path = store_path(dataset, level, modified_io, store_dir)
+    od.units = {'id': od.units['id'], **{c: np.asarray(od.units[c], dtype=float) for c in select_feat}}
+    od.save(path, {'dataset': dataset, 'level': level, 'modified_io': modified_io})
+    return path
+
+
+@profiled
+def load_store(dataset, level, columns=None, unit_columns=None, modified_io=False, store_dir=STORE_DIR,
+               mmap_mode='r', dtype=None):
+    # Open a store built by convert_to_store() as an ODPairs table. Only the requested pair/unit columns are
+    # opened, and with mmap_mode='r' nothing is read from disk until it is touched. With `dtype` the pair columns
+    # are converted (and read into memory) unless they are already stored in that type.
+    od = ODPairs.open(store_path(dataset, level, modified_io, store_dir), columns, unit_columns, mmap_mode)
+    return od if dtype is None else od.astype(dtype)
+
+
+def load_pairs(dataset, level, use_store=True, from_units=False, centroid_scale=1.):
+    # ODPairs table of a dataset: from the columnar store written by convert_store.py when it exists,
+    # otherwise from the raw files (from_units: flows and attribute table only, see pairs_from_units)
+    if use_store and os.path.exists(store_path(dataset, level)):
+        return load_store(dataset, level)
+    elif from_units:
+        return pairs_from_units(dataset, level, centroid_scale=centroid_scale)
+    elif dataset == 'gd_commute':
+        return load_gd_commute_data(select_feat=STORE_FEAT[dataset], level=level, csr=True)
+    elif dataset == 'gd_mobility':
+        return load_gd_mobility_data(select_feat=STORE_FEAT[dataset], level=level, csr=True)
+    else:
+        flow, dist, iores, iowork, attr = load_data_files(dataset, level, select_feat=STORE_FEAT[dataset])
+        return pairs_from_dicts(flow, dist, iores, iowork, attr, STORE_FEAT[dataset])
+
+
+def julia_column(od, col, idx=slice(None)):
+    # Values of a column of JULIA_X at the pairs idx: a pair column, or (unit attribute, 'ori'/'dest')
+    if isinstance(col, str):
+        return np.asarray(od[col][idx], dtype=np.float64)
+    attr, side = col
+    return np.asarray(od.units[attr], dtype=np.float64)[(od.ori if side == 'ori' else od.dest)[idx]]
+
+
+@profiled
+def export_julia(od, dataset, filename, columns=None, sort_ids=None, chunk_pairs=JULIA_CHUNK, compression=None):
+    # Write the SR inputs of the Julia drivers to an HDF5 file (readable with JLD2.jl or HDF5.jl):
+    #   X/<name>: the columns of X (columns: name -> column as in JULIA_X, default JULIA_X[dataset]),
+    #   y: observed flows, ori_sep: cumulative pair counts of the origins as in Julia (no leading 0, the pairs of
+    #   origin i are ori_sep[i-1]+1:ori_sep[i]), units: unit ids in origin order.
+    # The pairs are in the order of the drivers: units and their destinations sorted by id (sort_ids, default for
+    # the nested-dict datasets) or in the row/column order of the flow matrix (Guangdong datasets).
+    # The arrays are written in chunks of chunk_pairs pairs, so od may be memory-mapped (see load_store).
+    import h5py
+
+    columns = JULIA_X[dataset] if columns is None else columns
+    if sort_ids is None:
+        sort_ids = dataset not in ['gd_commute', 'gd_mobility']
+    n = len(od)
+    if sort_ids:
+        rank = np.empty(od.n_units, dtype=np.int64)
+        rank[np.argsort(od.units['id'], kind='stable')] = np.arange(od.n_units)
+        units = np.argsort(rank)
+        order = np.lexsort((rank[od.dest], rank[od.ori]))
+    else:
+        units = np.arange(od.n_units)
+        order = np.lexsort((od.dest, od.ori))
+    counts = np.diff(od.ori_sep)[units]
+    chunks = (min(chunk_pairs, n),) if n else None
+    with h5py.File(filename, "w") as f:
+        f.create_dataset('ori_sep', data=np.cumsum(counts).astype(np.int64))
+        ids = np.asarray(od.units['id'])[units]
+        f.create_dataset('units', data=ids.astype('S') if ids.dtype.kind in 'OU' else ids)
+        group = f.create_group('X')
+        group.attrs['columns'] = list(columns)
+        out = {name: group.create_dataset(name, (n,), dtype=np.float64, chunks=chunks, compression=compression)
+               for name in columns}
+        out['y'] = f.create_dataset('y', (n,), dtype=np.float64, chunks=chunks, compression=compression)
+        for s in range(0, n, chunk_pairs):
+            idx = order[s:s + chunk_pairs]
+            for name, col in dict(columns, y='flow').items():
+                out[name][s:s + len(idx)] = julia_column(od, col, idx)
+    return filename
+
+
+def save_arrays(folder, arrays):
+    # One .npy file per array, so that other processes can memory-map them (see open_arrays)
+    os.makedirs(folder, exist_ok=True)
+    for name, arr in arrays.items():
+        np.save(os.path.join(folder, name + ".npy"), arr)
+
+
+def create_array(folder, name, shape, dtype=np.float64):
+    # Zero-filled array written in place by other processes (see open_arrays), without a copy in memory
+    os.makedirs(folder, exist_ok=True)
+    arr = np.lib.format.open_memmap(os.path.join(folder, name + ".npy"), mode='w+', dtype=dtype, shape=shape)
+    del arr
+
+
+def shared_tempdir(prefix):
+    # Temporary folder for arrays shared between processes with save_arrays/open_arrays (in memory on Linux)
+    return tempfile.mkdtemp(prefix=prefix, dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+
+
+def open_arrays(folder, names, mmap_mode='r'):
+    # Arrays written by save_arrays. With mmap_mode, processes opening the same files share the pages
+    # instead of holding copies; mmap_mode='r+' gives a writable shared buffer.
+    return {name: np.load(os.path.join(folder, name + ".npy"), mmap_mode=mmap_mode) for name in names}
@@ -0,0 +1,99 @@
+# =================================================================================================================
+# Description: This file contains the evaluation metrics of allocation models (RMSE, MAE, MAPE, CPC), shared by
+# ./bench_allocation.py and the synthetic flow generator.
+# The metrics are computed from running sums (count, squared, absolute and relative errors, total observed and
+# predicted flow) accumulated over blocks of consecutive origins, so a single pass over the pairs gives the overall
+# metrics and, at the same time, their breakdown by origin and by distance band, with temporaries bounded by the
+# block size.
+# =================================================================================================================
+import numpy as np
+import pandas as pd
+from lib_profile import profiled
+
+BLOCK_PAIRS = 2 ** 20  # number of OD pairs per block of origins
+EPS = np.finfo(np.float64).eps  # floor of |Y| in MAPE, as in sklearn
+SUMS = ('n', 'sq', 'abs', 'rel', 'sum_y', 'sum_pred')
+
+
+def origin_blocks(ori_sep, block_pairs=BLOCK_PAIRS):
+    # Consecutive origin ranges [a, b) holding about block_pairs pairs each (at least one origin)
+    n_origins = len(ori_sep) - 1
+    a = 0
+    while a < n_origins:
+        b = np.searchsorted(ori_sep, ori_sep[a] + block_pairs, side='right') - 1
+        b = min(max(b, a + 1), n_origins)
+        yield a, b
+        a = b
+
+
+def metrics_from_sums(sums):
+    # RMSE, MAE, MAPE and CPC from sums (..., len(SUMS)); groups without pairs get NaN
+    sums = np.asarray(sums, dtype=np.float64)
+    n, sq, ab, rel, sum_y, sum_pred = np.moveaxis(sums, -1, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {'rmse': np.sqrt(sq / n), 'mae': ab / n, 'mape': rel / n, 'cpc': 1 - ab / (sum_y + sum_pred)}
+
+
+class FlowMetrics:
+    # Running sums of the metrics between observed flows Y and predictions, updated block by block.
+    # n_origins: also sum by origin; bands: also sum by distance band (increasing band edges, band k holds
+    # bands[k-1] <= dist < bands[k], band 0 is below bands[0] and band len(bands) above the last edge).
+    def __init__(self, n_origins=None, bands=None):
+        self.total = np.zeros(len(SUMS))
+        self.by_origin = None if n_origins is None else np.zeros((n_origins, len(SUMS)))
+        self.bands = None if bands is None else np.asarray(bands, dtype=np.float64)
+        self.by_band = None if bands is None else np.zeros((len(self.bands) + 1, len(SUMS)))
+
+    def update(self, Y, pred, origin=None, dist=None):
+        # origin: origin index of each pair (with n_origins), dist: distance of each pair (with bands)
+        Y = np.asarray(Y, dtype=np.float64)
+        pred = np.asarray(pred, dtype=np.float64)
+        ab = np.abs(pred - Y)
+        rel = ab / np.maximum(np.abs(Y), EPS)
+        self.total += [len(Y), np.dot(ab, ab), ab.sum(), rel.sum(), Y.sum(), pred.sum()]
+        band = None if self.bands is None else np.searchsorted(self.bands, dist, 'right')
+        for sums, group in [(self.by_origin, origin), (self.by_band, band)]:
+            if sums is None:
+                continue
+            sums[:, 0] += np.bincount(group, minlength=len(sums))
+            for k, w in enumerate([ab * ab, ab, rel, Y, pred], start=1):
+                sums[:, k] += np.bincount(group, weights=w, minlength=len(sums))
+
+    def result(self):
+        return {k: float(v) for k, v in metrics_from_sums(self.total).items()}
+
+    def origin_table(self):
+        # Metrics of each origin (NaN for origins without pairs)
+        return pd.DataFrame({'origin': np.arange(len(self.by_origin)), 'n_pairs': self.by_origin[:, 0].astype(int),
+                             **metrics_from_sums(self.by_origin)})
+
+    def band_table(self):
+        # Metrics of each distance band, with its bounds
+        edges = np.concatenate(([-np.inf], self.bands, [np.inf]))
+        return pd.DataFrame({'dist_min': edges[:-1], 'dist_max': edges[1:], 'n_pairs': self.by_band[:, 0].astype(int),
+                             **metrics_from_sums(self.by_band)})
+
+
+@profiled
+def flow_metrics(Y, pred, ori_sep=None, dist=None, bands=None, by_origin=False, observed=None,
+                 block_pairs=BLOCK_PAIRS):
+    # Metrics of pred against Y (both possibly memory-mapped) in one pass over blocks of origins (ori_sep, or blocks
+    # of block_pairs pairs without it). Returns the FlowMetrics; by_origin requires ori_sep, bands requires dist.
+    # observed: boolean mask of the pairs counted in the metrics (default: all)
+    n = len(Y)
+    if ori_sep is None:
+        ori_sep = np.append(np.arange(0, n, block_pairs), n)
+    ori_sep = np.asarray(ori_sep, dtype=np.int64)
+    metrics = FlowMetrics(len(ori_sep) - 1 if by_origin else None, bands)
+    for a, b in origin_blocks(ori_sep, block_pairs):
+        s, e = ori_sep[a], ori_sep[b]
+        origin = np.repeat(np.arange(a, b), np.diff(ori_sep[a:b + 1])) if by_origin else None
+        Yb, pb = Y[s:e], pred[s:e]
+        db = None if bands is None else np.asarray(dist[s:e])
+        if observed is not None:
+            keep = np.asarray(observed[s:e])
+            Yb, pb = np.asarray(Yb)[keep], np.asarray(pb)[keep]
+            origin = None if origin is None else origin[keep]
+            db = None if db is None else db[keep]
+        metrics.update(Yb, pb, origin, db)
+    return metrics
@@ -0,0 +1,101 @@
+# =================================================================================================================
+# Description: This file contains the writer of per-pair results (pair attributes and predicted flows).
+# The columns are streamed in blocks of rows to Parquet (requires pyarrow), CSV, or a write-only xlsx, so memory use
+# does not grow with the number of OD pairs. The columns can be memory-mapped arrays.
+# =================================================================================================================
+import numpy as np
+import pandas as pd
+import openpyxl
+from lib_profile import profiled
+
+XLSX_MAX_ROWS = 1048575  # Excel row limit, minus the header
+XLSX_AUTO_ROWS = 100000  # largest table written as xlsx by default (openpyxl is slow on large sheets)
+CHUNK_ROWS = 500000
+
+
+def pick_format(n_rows, fmt='auto'):
+    # xlsx for small tables, otherwise Parquet if pyarrow is installed, otherwise CSV
+    if fmt != 'auto':
+        return fmt
+    if n_rows <= XLSX_AUTO_ROWS:
+        return 'xlsx'
+    try:
+        import pyarrow
+        return 'parquet'
+    except ImportError:
+        return 'csv'
+
+
+class Gather:
+    # Lazy column values[index], gathered block by block by write_results (e.g. unit ids of the pairs)
+    def __init__(self, values, index):
+        self.values = values
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, key):
+        return self.values[self.index[key]]
+
+
+class ResultSink:
+    def __init__(self, filename, fmt):
+        self.filename = filename
+        self.fmt = fmt
+        self.n_rows = 0
+        self._writer = None
+        if fmt == 'xlsx':
+            self._wb = openpyxl.Workbook(write_only=True)
+            self._writer = self._wb.create_sheet()
+        elif fmt == 'csv':
+            self._file = open(filename, "w", newline="")
+        elif fmt != 'parquet':
+            raise NotImplementedError(f"Unknown result format {fmt}")
+
+    def write(self, block):
+        # block: dict of column name -> 1-d array, all of the same length
+        df = pd.DataFrame(block)
+        if self.fmt == 'xlsx':
+            if self.n_rows + len(df) > XLSX_MAX_ROWS:
+                raise ValueError(f"{self.filename}: more than {XLSX_MAX_ROWS} rows, use Parquet or CSV")
+            if self.n_rows == 0:
+                self._writer.append(list(df.columns))
+            for row in df.itertuples(index=False):
+                self._writer.append(list(row))
+        elif self.fmt == 'csv':
+            df.to_csv(self._file, header=self.n_rows == 0, index=False)
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(self.filename, table.schema)
+            self._writer.write_table(table)
+        self.n_rows += len(df)
+
+    def close(self):
+        if self.fmt == 'xlsx':
+            self._wb.save(self.filename)
+        elif self.fmt == 'csv':
+            self._file.close()
+        elif self._writer is not None:
+            self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+@profiled
+def write_results(filename, columns, fmt='auto', chunk_rows=CHUNK_ROWS):
+    # Write the columns (dict of name -> 1-d array) to `filename` + the extension of the chosen format
+    n_rows = len(next(iter(columns.values())))
+    fmt = pick_format(n_rows, fmt)
+    filename = f"{filename}.{fmt}"
+    with ResultSink(filename, fmt) as sink:
+        for start in range(0, n_rows, chunk_rows):
+            sink.write({name: np.asarray(col[start: start + chunk_rows]) for name, col in columns.items()})
+    return filename
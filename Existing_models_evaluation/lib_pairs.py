@@ -0,0 +1,82 @@
+# =================================================================================================================
+# Description: This file contains `ODPairs`, the OD-pair table shared by the loaders, ./bench_allocation.py, the
+# synthetic flow generator and the exporters.
+# Pairs are ordered by origin: ori/dest are int32 indices into the unit table, the pairs of origin i are
+# ori_sep[i]:ori_sep[i+1], and every pair column (flow, dist, iores, iowork, ...) is a separate 1-d float array, so
+# that columns are handed out as views (possibly memory-mapped) without copying.
+# =================================================================================================================
+import json
+import os
+import numpy as np
+
+
+class ODPairs:
+    def __init__(self, ori, dest, columns, units, ori_sep=None, outflow=None):
+        # columns: dict of pair column name -> 1-d array, units: dict with the unit 'id' and unit attributes
+        self.ori = np.asarray(ori, dtype=np.int32)
+        self.dest = np.asarray(dest, dtype=np.int32)
+        self.columns = dict(columns)
+        self.units = dict(units)
+        n_units = len(self.units['id'])
+        if ori_sep is None:
+            ori_sep = np.concatenate(([0], np.cumsum(np.bincount(self.ori, minlength=n_units))))
+        self.ori_sep = np.asarray(ori_sep, dtype=np.int64)
+        if outflow is None and 'flow' in self.columns:
+            cumflow = np.concatenate(([0.], np.cumsum(self.columns['flow'], dtype=np.float64)))
+            outflow = cumflow[self.ori_sep[1:]] - cumflow[self.ori_sep[:-1]]
+        self.outflow = None if outflow is None else np.asarray(outflow, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.ori)
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    @property
+    def n_units(self):
+        return len(self.units['id'])
+
+    def features(self, io, attr, start=0, stop=None):
+        # Inputs of the allocation laws: [dis, io, md, mo] of the pairs start:stop (default: all); dist and io are
+        # views of the pair columns
+        mattr = np.asarray(self.units[attr], dtype=self.columns['dist'].dtype)
+        pairs = slice(start, stop)
+        return [self.columns['dist'][pairs], self.columns[io][pairs], mattr[self.dest[pairs]],
+                mattr[self.ori[pairs]]]
+
+    def astype(self, dtype):
+        # Table with the float columns in `dtype` (columns already in `dtype` are shared, not copied)
+        columns = {c: np.asarray(v, dtype=dtype) for c, v in self.columns.items()}
+        return ODPairs(self.ori, self.dest, columns, self.units, self.ori_sep, self.outflow)
+
+    def save(self, folder, meta=None):
+        # One .npy file per array (pair columns, ori_sep, outflow, unit_* columns) and meta.json
+        os.makedirs(folder, exist_ok=True)
+        arrays = {'ori': self.ori, 'dest': self.dest, 'ori_sep': self.ori_sep, **self.columns}
+        if self.outflow is not None:
+            arrays['outflow'] = self.outflow
+        arrays.update({'unit_' + c: np.asarray(v) for c, v in self.units.items()})
+        for name, arr in arrays.items():
+            np.save(os.path.join(folder, name + ".npy"), arr)
+        meta = dict(meta or {}, n_units=self.n_units, n_pairs=len(self), pair_columns=list(self.columns),
+                    unit_columns=[c for c in self.units if c != 'id'], outflow=self.outflow is not None)
+        with open(os.path.join(folder, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def open(cls, folder, columns=None, unit_columns=None, mmap_mode='r'):
+        # Table saved by save(). Only the requested columns are opened, memory-mapped unless mmap_mode is None.
+        with open(os.path.join(folder, "meta.json")) as f:
+            meta = json.load(f)
+        columns = meta['pair_columns'] if columns is None else columns
+        unit_columns = meta['unit_columns'] if unit_columns is None else unit_columns
+        missing = (set(columns) - set(meta['pair_columns'])) | (set(unit_columns) - set(meta['unit_columns']))
+        if missing:
+            raise ValueError(f"Columns {missing} not found in {folder}")
+
+        def load(name, mode=mmap_mode):
+            return np.load(os.path.join(folder, name + ".npy"), mmap_mode=mode)
+        units = {'id': load('unit_id', None)}
+        units.update({c: load('unit_' + c) for c in unit_columns})
+        return cls(load('ori'), load('dest'), {c: load(c) for c in columns}, units, load('ori_sep', None),
+                   load('outflow', None) if meta['outflow'] else None)
@@ -0,0 +1,223 @@
+# =================================================================================================================
+# Description: This file contains the opt-in instrumentation of the benchmark and simulation runs.
+# The stages (loaders, pair preparation, loss evaluations, optimizer iterations, metrics, output) are marked with the
+# `profiled` decorator, the `stage` context manager or `count`; when tracing is on, the wall time, the calls and
+# optionally the peak memory of each stage are accumulated, and a JSON trace is written at exit:
+#   {"argv": [...], "wall": s, "peak_rss_mb": MB, "stages": {name: {"calls": n, "time": s, "peak_mb": MB}}}
+# peak_rss_mb is the peak RSS of the whole process. With memory tracing, the peak memory of a stage is the largest
+# amount of memory allocated during one of its calls on top of what was allocated when it started (NumPy arrays
+# included), measured with tracemalloc; stages running at the same time on other threads add to each other's peak.
+# tracemalloc slows down the allocations of the whole process, so it is opt-in: without it peak_mb is 0 and the
+# times are not distorted.
+# Tracing is turned on with the --trace/--trace-memory/--profile options of bench_allocation.py, or for any script by
+# setting the environment variables FLOWSR_TRACE (trace file), FLOWSR_TRACE_MEMORY (any value: memory tracing) and
+# FLOWSR_PROFILE (cProfile dump of the main process; the worker processes write theirs to FLOWSR_PROFILE.<pid>).
+# Worker processes return their stages with `pop_stats`, which the main process adds to its own with `merge`
+# (`task` and `merge_task` do both for tasks returning a dict). When tracing is off, the instrumentation only costs
+# one test per call.
+# =================================================================================================================
+import atexit
+import cProfile
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+TRACE_ENV = "FLOWSR_TRACE"
+PROFILE_ENV = "FLOWSR_PROFILE"
+MEMORY_ENV = "FLOWSR_TRACE_MEMORY"
+OWNER_ENV = "FLOWSR_TRACE_PID"  # pid of the process writing the trace, the others are workers
+
+_enabled = False
+_memory = False  # peak memory of the stages with tracemalloc
+_stats = dict()  # stage name -> {'calls', 'time', 'peak_mb'}
+_profiler = None
+_start = None
+_open = []  # [allocated at the start, peak so far] of the stages in progress (all threads)
+_lock = threading.Lock()
+
+
+def peak_rss_mb():
+    # Peak resident set size of this process since it started (MB), NaN where it cannot be measured
+    if resource is not None:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss / 1024 ** 2 if sys.platform == 'darwin' else rss / 1024  # bytes on macOS, KB on Linux
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 1024 ** 2
+    except (ImportError, AttributeError):
+        return float('nan')
+
+
+def record(name, seconds=0., calls=1, peak_mb=0.):
+    if not _enabled:
+        return
+    s = _stats.setdefault(name, {'calls': 0, 'time': 0., 'peak_mb': 0.})
+    s['calls'] += calls
+    s['time'] += seconds
+    s['peak_mb'] = max(s['peak_mb'], peak_mb)
+
+
+def _enter_memory():
+    # Start measuring the peak allocation of a stage; tracemalloc has a single peak, so before resetting it the
+    # peak so far is kept by the stages in progress
+    with _lock:
+        current, peak = tracemalloc.get_traced_memory()
+        for frame in _open:
+            frame[1] = max(frame[1], peak)
+        tracemalloc.reset_peak()
+        frame = [current, current]
+        _open.append(frame)
+    return frame
+
+
+def _exit_memory(frame):
+    # Peak allocation (MB) of a stage since _enter_memory, on top of what was allocated at its start
+    with _lock:
+        peak = tracemalloc.get_traced_memory()[1]
+        _open.remove(frame)
+        for f in _open + [frame]:
+            f[1] = max(f[1], peak)
+    return (frame[1] - frame[0]) / 1024 ** 2
+
+
+def count(name):
+    # One call of a stage without timing, e.g. an optimizer iteration
+    record(name)
+
+
+@contextmanager
+def stage(name):
+    if not _enabled:
+        yield
+        return
+    start = time.perf_counter()
+    frame = _enter_memory() if _memory else None
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start, peak_mb=0. if frame is None else _exit_memory(frame))
+
+
+def profiled(func=None, name=None):
+    # Decorator recording each call of func as the stage `name` (default: func.__name__); also usable as
+    # profiled(name=...) or to wrap a library function, profiled(pickle.load, name='unpickle')
+    if func is None:
+        return functools.partial(profiled, name=name)
+    name = func.__name__ if name is None else name
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return func(*args, **kwargs)
+        with stage(name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def task(func):
+    # Decorator of the tasks run in worker processes, which return a dict: the call is recorded as a stage and the
+    # stages of the worker are returned under 'trace' (see merge_task)
+    func = profiled(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        result = func(*args, **kwargs)
+        if _enabled:
+            result['trace'] = pop_stats()
+        return result
+    return wrapper
+
+
+def merge_task(result):
+    # Add the stages returned by a task (see task) to this process and remove them from its result
+    merge(result.pop('trace', None))
+    return result
+
+
+def start(trace, profile=None, memory=False):
+    # Turn tracing on in this process and in the worker processes it starts (through the environment); the trace
+    # (and the cProfile dump) are written at exit. memory: also measure the peak memory of the stages. No-op if
+    # tracing was already started from the environment
+    global _enabled, _memory, _profiler, _start
+    if _enabled:
+        return
+    _enabled, _memory, _start = True, bool(memory), time.time()
+    if _memory:
+        os.environ[MEMORY_ENV] = "1"
+        tracemalloc.start()
+    os.environ[TRACE_ENV] = trace
+    os.environ[OWNER_ENV] = str(os.getpid())
+    if profile:
+        os.environ[PROFILE_ENV] = profile
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    atexit.register(_finish, trace, profile)
+
+
+def worker_init():
+    # Initializer of the worker processes: forked workers inherit the stages of the main process, start afresh
+    global _enabled, _memory, _profiler
+    _stats.clear()
+    _open.clear()
+    _enabled = bool(os.environ.get(TRACE_ENV))
+    _memory = _enabled and bool(os.environ.get(MEMORY_ENV))
+    _profiler = None
+    if _memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if _enabled and os.environ.get(PROFILE_ENV):
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+
+
+def pop_stats():
+    # Stages recorded by this (worker) process since the last call, None when tracing is off; also updates the
+    # cProfile dump of the process
+    if not _enabled:
+        return None
+    stats = {k: dict(v) for k, v in _stats.items()}
+    _stats.clear()
+    if _profiler is not None:
+        _profiler.dump_stats(f"{os.environ[PROFILE_ENV]}.{os.getpid()}")
+    return stats
+
+
+def merge(stats):
+    # Add the stages of a worker process (see pop_stats)
+    if not _enabled or not stats:
+        return
+    for name, s in stats.items():
+        t = _stats.setdefault(name, {'calls': 0, 'time': 0., 'peak_mb': 0.})
+        t['calls'] += s['calls']
+        t['time'] += s['time']
+        t['peak_mb'] = max(t['peak_mb'], s['peak_mb'])
+
+
+def trace():
+    return {'argv': sys.argv, 'pid': os.getpid(), 'wall': time.time() - _start, 'peak_rss_mb': peak_rss_mb(),
+            'stages': _stats}
+
+
+def _finish(trace_file, profile):
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler.dump_stats(profile)
+    with open(trace_file, "w") as f:
+        json.dump(trace(), f, indent=1)
+
+
+# Scripts without a --trace option are traced by setting FLOWSR_TRACE (and FLOWSR_TRACE_MEMORY, FLOWSR_PROFILE) in
+# the environment
+if os.environ.get(TRACE_ENV) and os.environ.get(OWNER_ENV, str(os.getpid())) == str(os.getpid()):
+    start(os.environ[TRACE_ENV], os.environ.get(PROFILE_ENV), bool(os.environ.get(MEMORY_ENV)))
+elif os.environ.get(TRACE_ENV):
+    worker_init()  # spawned worker process
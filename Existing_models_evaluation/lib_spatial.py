@@ -0,0 +1,284 @@
+# =================================================================================================================
+# Description: This file contains the spatial index over unit centroids used by the approximate allocation of
+# ./bench_allocation.py (--neighbours / --radius).
+# Each origin is paired only with its k nearest destinations or with those within a radius, found with a KD-tree
+# over the centroids; all other destinations are merged into TAIL_BANDS tail pseudo-destinations per origin, one per
+# distance band (geometric bands from the farthest candidate to the farthest unit), so that the laws are evaluated
+# and fitted in O(N·k) time and memory instead of O(N²). The bands are built once in one O(N²) pass over blocks of
+# origins, in O(N) memory per origin of a block. A band sits at the mean distance of its destinations weighted by
+# their attribute, carries their total attribute and the observed flow to them: this gives the share of the tail
+# exactly for RM and IO (their allocation telescopes over consecutive destinations), and approximately for the laws
+# decreasing with distance, whose decay is averaged within each band (the fewer the bands, the larger the bias).
+# truncation_error measures the approximation against the allocation over all destinations.
+# pair_features computes the distance and intervening opportunities of OD pairs from the centroids and the
+# populations of the units, in blocks of origins processed in parallel, without precomputed N² tables.
+# =================================================================================================================
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy.spatial import cKDTree
+from lib_pairs import ODPairs
+from lib_profile import profiled
+
+EARTH_RADIUS = 6371.0088  # km, distances between (lon, lat) centroids are great-circle distances in km
+BLOCK_CELLS = 2 ** 21  # number of (origin, unit) distances held per block of origins in pair_features
+TAIL_BANDS = 8  # tail pseudo-destinations per origin in truncate_pairs
+
+
+def tree_points(xy, geographic=False):
+    # Points of the KD-tree: projected (x, y) as they are, (lon, lat) in degrees as unit vectors, whose chord
+    # distance increases with the great-circle distance
+    xy = np.asarray(xy, dtype=float)
+    if not geographic:
+        return xy
+    lon, lat = np.radians(xy[:, 0]), np.radians(xy[:, 1])
+    return np.column_stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)))
+
+
+def chord_to_dist(chord, geographic=False):
+    if not geographic:
+        return chord
+    return 2 * EARTH_RADIUS * np.arcsin(np.minimum(chord / 2, 1))
+
+
+def dist_to_chord(dist, geographic=False):
+    if not geographic:
+        return dist
+    return 2 * np.sin(np.minimum(dist / (2 * EARTH_RADIUS), np.pi / 2))
+
+
+def intervening(dist, mass, ori_sep):
+    # Intervening opportunities of pairs sorted by distance within each origin (pairs of origin i are
+    # ori_sep[i]:ori_sep[i+1]): total mass of the destinations of the same origin strictly closer than each one
+    dist = np.asarray(dist)
+    cum = np.cumsum(mass, dtype=np.float64) - mass
+    first = np.ones(len(dist), dtype=bool)  # first pair of each run of equal distances
+    first[1:] = dist[1:] != dist[:-1]
+    starts = ori_sep[:-1][np.diff(ori_sep) > 0]
+    first[starts] = True
+    first = np.maximum.accumulate(np.where(first, np.arange(len(dist)), 0))
+    return cum[first] - cum[np.repeat(ori_sep[:-1], np.diff(ori_sep))]
+
+
+def _pair_feature_block(points, masses, a, b, ori, dest, geographic, modified_io):
+    # Features of the pairs (ori, dest) of origins a..b-1 from the distances of these origins to all units
+    n = len(points)
+    D = np.zeros((b - a, n))
+    for k in range(points.shape[1]):
+        D += (points[a:b, k, None] - points[None, :, k]) ** 2
+    D = np.sqrt(D)
+    D[np.arange(b - a), np.arange(a, b)] = -1  # the origin sorts first, before any unit at distance 0
+    order = np.argsort(D, axis=1, kind='stable')
+    Ds = np.take_along_axis(D, order, axis=1)
+    first = np.ones(D.shape, dtype=bool)  # first position of each run of equal distances
+    first[:, 1:] = Ds[:, 1:] != Ds[:, :-1]
+    first = np.maximum.accumulate(np.where(first, np.arange(n), 0), axis=1)
+    rank = np.empty_like(order)  # position of each unit in the sorted row of its origin
+    np.put_along_axis(rank, order, np.arange(n)[None, :], axis=1)
+
+    r = ori - a
+    pos = first[r, rank[r, dest]]
+    features = {'dist': chord_to_dist(D[r, dest], geographic)}
+    for name, mass in masses.items():
+        ms = mass[order]
+        ms[:, 0] = 0  # the origin itself is not an intervening opportunity
+        cum = np.cumsum(ms, axis=1) - ms
+        features[name] = cum[r, pos] + mass[ori] if modified_io else cum[r, pos]
+    return features
+
+
+@profiled
+def pair_features(xy, ori, dest, masses, geographic=False, modified_io=False, jobs=None, dtype=np.float64,
+                  block_cells=BLOCK_CELLS):
+    # Distance and intervening opportunities of the pairs (ori, dest), ordered by origin, from the unit centroids xy.
+    # For each origin the units are sorted by distance and the mass of each array of `masses` (dict of name -> unit
+    # attribute) is summed cumulatively: io is the mass of the units strictly closer to the origin than the
+    # destination, without the origin itself (with it if modified_io). The origins are processed in blocks of about
+    # block_cells distances, in a pool of `jobs` processes (jobs=1: in this process).
+    # Returns a dict with 'dist' (projected units or km) and one array per mass, in `dtype`.
+    points = tree_points(xy, geographic)
+    masses = {name: np.asarray(mass, dtype=np.float64) for name, mass in masses.items()}
+    ori, dest = np.asarray(ori, dtype=np.int64), np.asarray(dest, dtype=np.int64)
+    n = len(points)
+    ori_sep = np.concatenate(([0], np.cumsum(np.bincount(ori, minlength=n))))
+    step = max(1, block_cells // max(n, 1))
+    blocks = [(a, min(a + step, n)) for a in range(0, n, step)]
+    args = [(points, masses, a, b, ori[ori_sep[a]:ori_sep[b]], dest[ori_sep[a]:ori_sep[b]], geographic, modified_io)
+            for a, b in blocks]
+    if jobs == 1:
+        results = [_pair_feature_block(*arg) for arg in args]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(_pair_feature_block, *zip(*args)))
+    return {name: np.concatenate([res[name] for res in results]).astype(dtype) for name in ['dist', *masses]}
+
+
+@profiled
+def nearest_candidates(xy, k=None, radius=None, geographic=False, workers=-1):
+    # Candidate destinations of each origin (itself excluded), sorted by distance: the k nearest, or all within
+    # `radius`. Returns ori_sep, dest and dist of the candidate pairs.
+    points = tree_points(xy, geographic)
+    n = len(points)
+    tree = cKDTree(points)
+    if k is not None:
+        k = min(k, n - 1)
+        chord, idx = tree.query(points, k + 1, workers=workers)
+        chord, idx = chord.reshape(n, k + 1), idx.reshape(n, k + 1)
+        drop = idx == np.arange(n)[:, None]
+        drop[~drop.any(axis=1), -1] = True  # origin not returned (duplicate centroids): drop the farthest instead
+        dest, chord = idx[~drop], chord[~drop]
+        ori_sep = np.arange(n + 1, dtype=np.int64) * k
+    elif radius is not None:
+        lists = tree.query_ball_point(points, dist_to_chord(radius, geographic), workers=workers)
+        ori = np.repeat(np.arange(n), [len(l) for l in lists])
+        dest = np.concatenate(lists).astype(np.int64)
+        keep = dest != ori
+        ori, dest = ori[keep], dest[keep]
+        chord = np.linalg.norm(points[ori] - points[dest], axis=1)
+        order = np.lexsort((dest, chord, ori))
+        dest, chord = dest[order], chord[order]
+        ori_sep = np.concatenate(([0], np.cumsum(np.bincount(ori, minlength=n))))
+    else:
+        raise ValueError("Either k or radius is required")
+    return ori_sep, dest.astype(np.int32), chord_to_dist(chord, geographic)
+
+
+def tail_band(dist, lo, hi, n_bands):
+    # Band of the distances dist in [lo, hi] (lo: farthest candidate, hi: farthest unit of the origin), out of
+    # n_bands geometric bands; band 0 when the bands are degenerate (lo == hi)
+    lo = np.maximum(lo, hi * 1e-6)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        band = n_bands * np.log(dist / lo) / np.log(hi / lo)
+    return np.clip(np.nan_to_num(band, nan=0., posinf=n_bands, neginf=0.), 0, n_bands - 1).astype(np.int64)
+
+
+def _tail_band_block(points, mass, lo, a, b, cand_ori, cand_dest, geographic, n_bands):
+    # Mass and mass-weighted distance sum of the units outside the candidates of origins a..b-1 in each of their
+    # tail bands, and the distance of the farthest unit of each origin
+    n = len(points)
+    D = np.zeros((b - a, n))
+    for k in range(points.shape[1]):
+        D += (points[a:b, k, None] - points[None, :, k]) ** 2
+    D = chord_to_dist(np.sqrt(D), geographic)
+    hi = D.max(axis=1)
+    outside = np.ones(D.shape, dtype=bool)
+    outside[np.arange(b - a), np.arange(a, b)] = False
+    outside[cand_ori - a, cand_dest] = False
+    r, j = np.nonzero(outside)
+    d = D[r, j]
+    idx = r * n_bands + tail_band(d, lo[a + r], hi[r], n_bands)
+    band_mass = np.bincount(idx, mass[j], minlength=(b - a) * n_bands)
+    band_dist = np.bincount(idx, mass[j] * d, minlength=(b - a) * n_bands)
+    return band_mass.reshape(b - a, n_bands), band_dist.reshape(b - a, n_bands), hi
+
+
+@profiled
+def truncate_pairs(od, xy, mass, k=None, radius=None, geographic=False, n_bands=TAIL_BANDS,
+                   block_cells=BLOCK_CELLS):
+    # Table of the candidate pairs of each origin (see nearest_candidates) followed by up to n_bands tail pairs
+    # (dest == ori) standing for all other destinations, one per distance band holding any mass (see tail_band),
+    # with the pair columns
+    #   flow: observed flow (for a band: observed flow to its destinations), dist: centroid distance (for a band: the
+    #   mean distance of its destinations weighted by mass), io: intervening opportunities (for a band: mass of the
+    #   candidates and of the closer bands), md: destination mass (for a band: mass of its destinations),
+    #   mo: origin mass.
+    # mass is the unit attribute used as md/mo and as the opportunities, in the order of the unit table. The bands
+    # are computed from the distances of blocks of about block_cells (origin, unit) pairs.
+    n = od.n_units
+    mass = np.asarray(mass, dtype=np.float64)
+    cand_sep, cand_dest, cand_dist = nearest_candidates(xy, k, radius, geographic)
+    counts = np.diff(cand_sep)
+    cand_ori = np.repeat(np.arange(n), counts)
+    cand_io = intervening(cand_dist, mass[cand_dest], cand_sep)
+
+    # Observed flow of the candidate pairs
+    cand_flow = np.zeros(len(cand_dest))
+    is_cand = np.zeros(len(od), dtype=bool)
+    if len(od):
+        key = od.ori.astype(np.int64) * n + od.dest
+        order = np.argsort(key, kind='stable')
+        key = key[order]
+        target = cand_ori.astype(np.int64) * n + cand_dest
+        pos = np.minimum(np.searchsorted(key, target), len(key) - 1)
+        hit = key[pos] == target
+        cand_flow[hit] = np.asarray(od['flow'])[order[pos[hit]]]
+        is_cand[order[pos[hit]]] = True
+    cand_mass = np.bincount(cand_ori, mass[cand_dest], minlength=n)
+    if radius is not None:
+        lo = np.full(n, float(radius))
+    else:
+        lo = np.zeros(n)
+        lo[counts > 0] = cand_dist[cand_sep[1:][counts > 0] - 1]
+
+    # Tail bands of the destinations outside the candidates, and the observed flow to each of them
+    points = tree_points(xy, geographic)
+    step = max(1, block_cells // max(n, 1))
+    blocks = [(a, min(a + step, n)) for a in range(0, n, step)]
+    results = [_tail_band_block(points, mass, lo, a, b, cand_ori[cand_sep[a]:cand_sep[b]],
+                                cand_dest[cand_sep[a]:cand_sep[b]], geographic, n_bands) for a, b in blocks]
+    band_mass, band_dist, hi = [np.concatenate(arrays) for arrays in zip(*results)]
+    ori, dest = od.ori[~is_cand].astype(np.int64), od.dest[~is_cand]
+    d = chord_to_dist(np.linalg.norm(points[ori] - points[dest], axis=1), geographic)
+    band_flow = np.bincount(ori * n_bands + tail_band(d, lo[ori], hi[ori], n_bands),
+                            np.asarray(od['flow'])[~is_cand], minlength=n * n_bands).reshape(n, n_bands)
+    band_io = cand_mass[:, None] + np.cumsum(band_mass, axis=1) - band_mass
+    with np.errstate(divide='ignore', invalid='ignore'):
+        band_dist = band_dist / band_mass
+
+    keep = band_mass > 0
+    tail_ori = np.nonzero(keep)[0]
+    n_tail = keep.sum(axis=1)
+    tail = {'flow': band_flow[keep], 'dist': band_dist[keep], 'io': band_io[keep], 'md': band_mass[keep],
+            'mo': mass[tail_ori]}
+    cand = {'flow': cand_flow, 'dist': cand_dist, 'io': cand_io, 'md': mass[cand_dest], 'mo': mass[cand_ori]}
+
+    ori_sep = cand_sep + np.concatenate(([0], np.cumsum(n_tail)))
+    cand_pos = np.arange(len(cand_dest)) + (ori_sep[:-1] - cand_sep[:-1])[cand_ori]
+    is_tail = np.ones(ori_sep[-1], dtype=bool)  # the bands follow the candidates of their origin, in band order
+    is_tail[cand_pos] = False
+    tail_pos = np.flatnonzero(is_tail)
+    columns = dict()
+    for c in cand:
+        columns[c] = np.empty(ori_sep[-1])
+        columns[c][cand_pos] = cand[c]
+        columns[c][tail_pos] = tail[c]
+    dest = np.empty(ori_sep[-1], dtype=np.int32)
+    dest[cand_pos] = cand_dest
+    dest[tail_pos] = tail_ori
+    return ODPairs(np.repeat(np.arange(n), counts + n_tail), dest, columns, od.units, ori_sep, od.outflow)
+
+
+@profiled
+def truncation_error(law, param, X, dest, ori_sep, xy, mass, origins, outflow, geographic=False):
+    # Distance between the truncated allocation (features X = [dis, io, md, mo] and dest of a truncate_pairs
+    # table) and the allocation over all destinations computed from the centroids, on a sample of origins.
+    # Returns the share of their outflow allocated differently (total variation distance, candidates compared as in
+    # the truncated table and the tail bands as a whole) and the share the exact allocation sends outside the
+    # candidates.
+    points = tree_points(xy, geographic)
+    mass = np.asarray(mass, dtype=np.float64)
+    n = len(points)
+    tv = tail_share = weight = 0.
+    for i in origins:
+        # Exact allocation of origin i over all other units
+        others = np.delete(np.arange(n), i)
+        d = chord_to_dist(np.linalg.norm(points[others] - points[i], axis=1), geographic)
+        order = np.lexsort((others, d))
+        others, d = others[order], d[order]
+        io = intervening(d, mass[others], np.array([0, len(d)]))
+        p = law(d, io, mass[others], np.full(len(d), mass[i]), param)
+        exact = np.zeros(n)
+        exact[others] = p / np.sum(p)
+
+        s, e = ori_sep[i], ori_sep[i + 1]
+        q = law(*[np.asarray(c[s:e]) for c in X], param)
+        q = q / np.sum(q)
+        cand = np.asarray(dest[s:e])
+        tail = cand == i
+        cand, q, q_tail = cand[~tail], q[~tail], np.sum(q[tail])
+        exact_tail = 1 - np.sum(exact[cand])
+        tv += outflow[i] * 0.5 * (np.sum(np.abs(q - exact[cand])) + abs(q_tail - exact_tail))
+        tail_share += outflow[i] * exact_tail
+        weight += outflow[i]
+    if weight == 0:
+        return {'trunc_tv': np.nan, 'tail_share': np.nan}
+    return {'trunc_tv': tv / weight, 'tail_share': tail_share / weight}
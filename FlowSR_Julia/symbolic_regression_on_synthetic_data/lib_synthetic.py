@@ -0,0 +1,149 @@
+"""
+Functions to generate synthetic flows from an allocation law, used by simulate_geo_allocation.py.
+The OD pairs are processed in blocks of consecutive origins: the allocation of a block is evaluated and normalized on
+dense slices of the pair arrays, noise is drawn with a numpy Generator, and only the flows reaching the threshold
+are streamed to a file as (origin index, destination index, volume) int64 rows. Memory use is bounded by the block
+size instead of the number of OD pairs.
+run_scenario generates one scenario of a sweep from feature arrays shared between worker processes.
+The noise of a scenario is drawn from noise_seed(seed, law, noisetype, sigma), which depends only on the scenario and
+not on its position in a sweep, so a scenario gives the same flows in a sweep of any grid and in single-scenario mode.
+"""
+from matplotlib.figure import Figure
+import hashlib
+import json
+import os
+import pickle
+import sys
+import tempfile
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../Existing_models_evaluation"))
+from lib_allocation import OriginPartition
+from lib_laws import FEATURES, get_law
+from lib_loaddata import open_arrays
+from lib_metrics import FlowMetrics, origin_blocks
+from lib_profile import profiled, task
+
+BLOCK_PAIRS = 2 ** 22  # number of OD pairs per block of origins
+NOISE_TYPES = ['mul', 'logadd']
+SIGMA_UNIT = 1e-6  # resolution of sigma in the seed of the noise
+
+
+def noise_seed(seed, modeltype, noisetype, sigma):
+    # SeedSequence of the noise of a scenario: the child of SeedSequence(seed) whose spawn_key holds integers
+    # identifying the scenario (a hash of the canonical name of the law, the index of the noise type and sigma in
+    # units of SIGMA_UNIT), so that every scenario has its own independent stream.
+    if noisetype not in NOISE_TYPES:
+        raise NotImplementedError
+    digest = hashlib.blake2b(get_law(modeltype).name.encode(), digest_size=8).digest()
+    return np.random.SeedSequence(seed, spawn_key=(int.from_bytes(digest, 'little'), NOISE_TYPES.index(noisetype),
+                                                   int(round(sigma / SIGMA_UNIT))))
+
+
+@profiled
+def generate_flows(law, param, X, dest, ori_sep, outflow, rng, out, noisetype='mul', sigma=0., thres=3,
+                   block_pairs=BLOCK_PAIRS):
+    # X: the feature columns [dis, io, md, mo] (see ODPairs.features), dest: destination index of each pair, pairs of
+    # origin i are ori_sep[i]:ori_sep[i+1] (the columns may be memory-mapped). The noise is drawn pair by pair in this
+    # order, so the result does not depend on block_pairs. Surviving flows are written to the binary file `out`
+    # (see read_flows).
+    # Returns the metrics between model and synthetic flows and the statistics of the surviving flows.
+    ori_sep = np.asarray(ori_sep, dtype=np.int64)
+    outflow = np.asarray(outflow, dtype=float)
+    n_origins = len(ori_sep) - 1
+    flowhist = np.zeros(0, dtype=np.int64)
+    outdeg = np.zeros(n_origins, dtype=np.int64)
+    metrics = FlowMetrics()
+
+    for a, b in origin_blocks(ori_sep, block_pairs):
+        s, e = ori_sep[a], ori_sep[b]
+        partition = OriginPartition(ori_sep[a:b + 1] - s)
+        Ymodel = law(*[np.asarray(c[s:e]) for c in X], param)
+        partition.normalize(Ymodel, outflow[a:b])
+
+        # Add Random Noise
+        noise = rng.standard_normal(e - s)
+        if noisetype == 'mul':
+            Ysyn = np.round(Ymodel * (1 + sigma * noise))
+        elif noisetype == 'logadd':
+            Ysyn = np.round(Ymodel * np.exp(sigma * noise))
+        else:
+            raise NotImplementedError
+
+        metrics.update(Ymodel, Ysyn)
+
+        keep = Ysyn >= thres
+        vol = Ysyn[keep].astype(np.int64)
+        outdeg[a:b] = partition.segment_sum(keep.astype(np.int64))
+        hist = np.bincount(vol)
+        if len(hist) > len(flowhist):
+            flowhist = np.concatenate((flowhist, np.zeros(len(hist) - len(flowhist), dtype=np.int64)))
+        flowhist[:len(hist)] += hist
+        ori = partition.expand(np.arange(a, b))[keep]
+        np.column_stack((ori, np.asarray(dest[s:e])[keep], vol)).astype(np.int64).tofile(out)
+
+    vals = np.nonzero(flowhist)[0]
+    nflow = int(flowhist.sum())
+    sumflow = int(np.dot(vals, flowhist[vals]))
+    return {**{k.upper(): v for k, v in metrics.result().items()},
+            'flownum': nflow, 'flowsum': sumflow, 'flowavg': sumflow / nflow if nflow else 0.,
+            'flowmax': int(vals[-1]) if nflow else 0,
+            'degavg': outdeg.mean(), 'degmax': int(outdeg.max()), 'degmin': int(outdeg.min()),
+            'flowhist': {int(v): int(flowhist[v]) for v in vals}}
+
+
+def read_flows(file):
+    # (origin index, destination index, volume) rows written by generate_flows
+    return np.fromfile(file, dtype=np.int64).reshape(-1, 3)
+
+
+@profiled
+def flows_to_dict(flows, units):
+    # Nested dict flowdict[o][d] = volume, the format read by the SR scripts
+    flowdict = {u: dict() for u in units}
+    for o, d, vol in flows.tolist():
+        flowdict[units[o]][units[d]] = vol
+    return flowdict
+
+
+@profiled
+def save_scenario(name, flowdict, meta):
+    # name.pkl: synthetic flows, name_meta.png: histogram of flow volumes, name_meta.txt: metadata
+    flowfile = open(f"{name}.pkl", "wb")
+    pickle.dump(flowdict, flowfile)
+    flowfile.close()
+
+    fig = Figure()
+    ax = fig.subplots()
+    ax.loglog(list(meta["flowhist"].keys()), list(meta["flowhist"].values()), '.', markersize=2)
+    ax.set_xlabel("Commuting Flow")
+    ax.set_ylabel("Frequency")
+    fig.savefig(f"{name}_meta.png")
+
+    fmeta = open(f"{name}_meta.txt", "w")
+    json.dump(meta, fmeta)
+    fmeta.close()
+    return {'pkl': f"{name}.pkl", 'png': f"{name}_meta.png", 'meta': f"{name}_meta.txt"}
+
+
+@task
+def run_scenario(folder, units, scenario, prefix, thres=3):
+    # Generate one scenario (dict with modeltype, noisetype, sigma, param and seed) of a sweep from the arrays shared
+    # in `folder`, with the noise of noise_seed.
+    arrays = open_arrays(folder, [*FEATURES, 'dest', 'ori_sep', 'outflow'])
+    law = get_law(scenario['modeltype'])
+    param = scenario['param'] if law.params else None
+    seq = noise_seed(scenario['seed'], scenario['modeltype'], scenario['noisetype'], scenario['sigma'])
+    rng = np.random.default_rng(seq)
+    meta = {'seed': scenario['seed'], 'spawn_key': list(seq.spawn_key)}
+    if law.params:
+        meta['param'] = param
+    with tempfile.TemporaryFile() as out:
+        meta.update(generate_flows(law, param, [arrays[f] for f in FEATURES], arrays['dest'], arrays['ori_sep'],
+                                   arrays['outflow'], rng, out, scenario['noisetype'], scenario['sigma'], thres))
+        out.seek(0)
+        flowdict = flows_to_dict(read_flows(out), units)
+    name = (f"{prefix}_{scenario['modeltype']}_{scenario['noisetype']}{scenario['sigma']}_supp{thres}_"
+            f"{scenario['seed']}")
+    files = save_scenario(name, flowdict, meta)
+    return dict(scenario, files=files, **{k: v for k, v in meta.items() if k not in ['flowhist', 'param']})
@@ -3,29 +3,47 @@ This script is used to generate flow based on different existing models with dif
 The existing model selected to generate flow is specified by parameter `modeltype`.
 Parameter `noisetype` specifies the type of noise, and `sigma` determines the standard deviation of the
 normal distribution noise introduced to the flow.
+Set the environment variables FLOWSR_TRACE (and FLOWSR_TRACE_MEMORY, FLOWSR_PROFILE) to trace the stages of the run,
+see ../../Existing_models_evaluation/lib_profile.py.
+The parameters of the models are those fitted by ../../Existing_models_evaluation/bench_allocation.py on the same
+dataset, level and attributes, read from the fit cache (see lib_fitcache.py); param_dict is only used for the models
+that have not been fitted yet.
 """
-from sklearn.metrics import mean_squared_error, mean_absolute_error, mean_absolute_percentage_error
-from math import sqrt, exp
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-from numpy.random import seed, randn
-from matplotlib import pyplot as plt
 import json
 import pickle
 import openpyxl
+import shutil
+import tempfile
+from lib_synthetic import *
+from lib_laws import FEATURES, get_law, init_worker
+from lib_loaddata import pairs_from_dicts, save_arrays, shared_tempdir
+from lib_profile import merge_task, profiled
+from lib_fitcache import FitCache
 
 cur_seed = 1231
-seed(cur_seed)
-meta = dict()
-meta["seed"] = cur_seed
-
 dataset = 'england'
 level = 'msoa'
-modeltype = "RM"  # ["GMZipf", "GMPow","GMExp","RM","ERM","IO","OPS"]
+modeltype = "RM"  # ["GMZipf", "GMPow","GMExp","RM","ERM","IO","OPS"] or any law registered in lib_laws.py
 use_work_attr = True
 noisetype = 'mul'  # ["mul", "logadd"]
 sigma = 0
+dtype = np.float64  # dtype of the feature columns, np.float32 halves their memory
+
+# Sweep mode: generate every combination of the lists below in parallel instead of the single scenario above.
+# The features are built once and shared by the worker processes, and all outputs are listed in one index file.
+# Both modes draw the noise of a scenario from lib_synthetic.noise_seed, so a scenario of a sweep reproduces the
+# single scenario with the same settings.
+sweep = False
+sweep_models = ["GMPow", "GMExp", "RM"]
+sweep_noisetypes = ["mul", "logadd"]
+sweep_sigmas = [0, 0.1, 0.5]
+sweep_seeds = [cur_seed]
+jobs = None  # number of worker processes (default: all cores)
 
 
+@profiled
 def load_england_data_files(level='msoa', select_feat=None):
     # feat: dist, o, d
     if level == 'msoa':
@@ -59,133 +77,78 @@ def load_england_data_files(level='msoa', select_feat=None):
     return flow_dict, dist_dict, iores_dict, iowork_dict, attr_dict
 
 
-if dataset == 'england':
-    flow, dist, iores, iowork, attr = load_england_data_files(level=level,
-                                                              select_feat=['respop', 'workpop'])
-    param_dict = {'msoa': {"GMPow": 1.33317602, "GMExp": 0.18416155}}
-else:
-    raise NotImplementedError
-units = sorted(dist.keys())
-N = len(units)
-print(N)
-
-outflow = {resid: sum(flow[resid].values()) for resid in units}
-if use_work_attr:
-    fid = 1  # 0: res 1: work
-    io = iowork
-else:
-    fid = 0
-    io = iores
-X = dict()
-for resid in units:
-    Xo = []
-    for workid in units:
-        if workid == resid:
-            continue
-        Xo.append([dist[resid][workid], io[resid][workid], attr[workid][fid], attr[resid][fid]])
-    Xo = np.asarray(Xo)
-    X[resid] = Xo
+def fitted_param(model, param_dict):
+    # Parameters of `model` fitted on all the origins of the dataset by bench_allocation.py, from the fit cache;
+    # param_dict[model] if there is no such fit
+    entry = FitCache().find(get_law(model), dataset=dataset, level=level, use_work_attr=use_work_attr,
+                            group=None, neighbours=None, radius=None)
+    if entry is not None:
+        return entry['param']
+    print(f"No fit of {model} on {dataset}:{level} in the fit cache, using {param_dict.get(model)}")
+    return param_dict.get(model)
 
 
-def allocation_law(dis, io, md, mo, param=None):
-    if modeltype == "GMZipf":
-        p = md / dis
-    elif modeltype == "GMPow":
-        p = md / (dis ** param)
-    elif modeltype == "GMExp":
-        p = md / exp(param * dis)
-    elif modeltype == "RM":
-        p = md / ((mo + io) * (mo + io + md))
-    elif modeltype == "ERM":
-        p = ((mo + io + md) ** param - (mo + io) ** param) * (1 + mo ** param) / \
-            ((1 + (mo + io) ** param) * (1 + (mo + io + md) ** param))
-    elif modeltype == "IO":
-        p = exp(param * io) - exp(param * (io + md))
-    elif modeltype == "OPS":
-        p = md / (mo + io + md)
+if __name__ == "__main__":
+    if dataset == 'england':
+        flow, dist, iores, iowork, attr = load_england_data_files(level=level,
+                                                                  select_feat=['respop', 'workpop'])
+        param_dict = {'msoa': {"GMPow": 1.33317602, "GMExp": 0.18416155}}
     else:
         raise NotImplementedError
-    return p
-
-
-def pred(param=None):
-    Y = []
-    for resid in units:
-        Xo = X[resid]
-        alloc = allocation_law(Xo[:, 0], Xo[:, 1], Xo[:, 2], Xo[:, 3], param)
-        stdfac = sum(alloc)
-        alloc *= outflow[resid] / stdfac
-        Y = np.concatenate((Y, alloc))
-    assert len(Y) == N * (N - 1)
-    return np.asarray(Y)
-
-
-if modeltype in ["GMPow", "GMExp", "IO", "ERM"]:
-    Ymodel = pred(param_dict[level][modeltype])
-    meta["param"] = param_dict[level][modeltype]
-else:  # parameter-free model
-    Ymodel = pred()
-
-# Add Random Noise
-if noisetype == 'mul':
-    Noise = np.asarray([1 + sigma * randn() for f in range(len(Ymodel))])
-    Yturb = Ymodel * Noise
-elif noisetype == 'logadd':
-    Noise = np.asarray([sigma * randn() for f in range(len(Ymodel))])
-    Yturb = Ymodel * np.exp(Noise)
-else:
-    raise NotImplementedError
-Ysyn = np.round(Yturb)
-
-rmse = sqrt(mean_squared_error(Ymodel, Ysyn))
-mae = mean_absolute_error(Ymodel, Ysyn)
-mape = mean_absolute_percentage_error(Ymodel, Ysyn)
-cpc = 1 - sum(np.abs(Ymodel - Ysyn)) / (sum(Ymodel) + sum(Ysyn))
-meta['RMSE'], meta['MAE'], meta['MAPE'], meta['CPC'] = rmse, mae, mape, cpc
-
-# Flow data
-flowdict = {resid: dict() for resid in units}
-flowhist = dict()
-
-thres = 3
-nflow = 0
-sumflow = 0
-for res in range(N):
-    resid = units[res]
-    for work in range(N):
-        if work == res:
-            continue
-        workid = units[work]
-        flowind = res * (N - 1) + work
-        if work > res:
-            flowind -= 1
-        vol = int(Ysyn[flowind])
-        if vol < thres:
-            continue
-        nflow += 1
-        sumflow += vol
-        flowdict[resid][workid] = vol
-        if vol in flowhist.keys():
-            flowhist[vol] += 1
-        else:
-            flowhist[vol] = 1
-meta["flownum"], meta["flowsum"], meta["flowavg"] = nflow, sumflow, sumflow / nflow
-meta["flowmax"] = max(flowhist.keys())
-outdeg = [len(d) for d in flowdict.values()]
-meta["degavg"], meta["degmax"], meta["degmin"] = sum(outdeg) / len(outdeg), max(outdeg), min(outdeg)
-
-flowfile = open(f"../../Data/synthetic/England/engmsoa_{modeltype}_{noisetype}{sigma}_supp{thres}_{cur_seed}.pkl", "wb")
-pickle.dump(flowdict, flowfile)
-flowfile.close()
-
-val = sorted(list(flowhist.keys()))
-freq = [flowhist[v] for v in val]
-plt.loglog(val, freq, '.', markersize=2)
-plt.xlabel("Commuting Flow")
-plt.ylabel("Frequency")
-plt.savefig(f"../../Data/synthetic/England/engmsoa_{modeltype}_{noisetype}{sigma}_supp{thres}_{cur_seed}_meta.png")
-meta["flowhist"] = flowhist
-
-fmeta = open(f"../../Data/synthetic/England/engmsoa_{modeltype}_{noisetype}{sigma}_supp{thres}_{cur_seed}_meta.txt","w")
-json.dump(meta, fmeta)
-fmeta.close()
+    units = sorted(dist.keys())
+    N = len(units)
+    print(N)
+
+    # Every origin paired with all other units, in the order of `units`
+    od = pairs_from_dicts(flow, dist, iores, iowork, attr, ['respop', 'workpop'], units=units, complete=True,
+                          dtype=dtype)
+    if use_work_attr:
+        X = od.features('iowork', 'workpop')
+    else:
+        X = od.features('iores', 'respop')
+    dest, ori_sep, outflow_arr = od.dest, od.ori_sep, od.outflow
+
+    thres = 3
+    prefix = "../../Data/synthetic/England/engmsoa"
+    if not sweep:
+        meta = dict()
+        meta["seed"] = cur_seed
+        law = get_law(modeltype)
+        if law.params:
+            param = fitted_param(modeltype, param_dict[level])
+            meta["param"] = param
+        else:  # parameter-free model
+            param = None
+
+        # Generate the flows of each block of origins, keeping those above the threshold
+        seq = noise_seed(cur_seed, modeltype, noisetype, sigma)
+        meta["spawn_key"] = list(seq.spawn_key)
+        rng = np.random.default_rng(seq)
+        with tempfile.TemporaryFile() as out:
+            meta.update(generate_flows(law, param, X, dest, ori_sep, outflow_arr, rng, out, noisetype, sigma,
+                                       thres))
+            out.seek(0)
+            flowdict = flows_to_dict(read_flows(out), units)
+        save_scenario(f"{prefix}_{modeltype}_{noisetype}{sigma}_supp{thres}_{cur_seed}", flowdict, meta)
+    else:
+        folder = shared_tempdir("synthetic_")
+        try:
+            save_arrays(folder, {**dict(zip(FEATURES, X)), 'dest': dest, 'ori_sep': ori_sep, 'outflow': outflow_arr})
+            del X, od
+            params = {m: fitted_param(m, param_dict[level]) if get_law(m).params else None for m in sweep_models}
+            scenarios = []
+            for seed in sweep_seeds:
+                for m in sweep_models:
+                    for nt in sweep_noisetypes:
+                        for sg in sweep_sigmas:
+                            scenarios.append({'modeltype': m, 'noisetype': nt, 'sigma': sg, 'seed': seed,
+                                              'param': params[m]})
+            with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker) as pool:
+                index = list(pool.map(run_scenario, [folder] * len(scenarios), [units] * len(scenarios), scenarios,
+                                      [prefix] * len(scenarios), [thres] * len(scenarios)))
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+        index = [merge_task(r) for r in index]
+        findex = open(f"{prefix}_sweep_supp{thres}_index.json", "w")
+        json.dump(index, findex, indent=1)
+        findex.close()